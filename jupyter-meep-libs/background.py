@@ -0,0 +1,280 @@
+''' Simulations in a background process, so the notebook stays usable during long runs.
+
+    ``launch`` starts the factory in its own process and returns a handle right away::
+
+        run = launch(bragg_setups.do_simrun, geo=geo, name='duty=.4')
+        run                      # duty=.4: running, t = 35.0, 812 steps/s, ETA 40 s
+        run.attach(dashboard)    # field snapshots go to a LiveDashboard panel as they arrive
+        run.cancel()
+        spectra = run.result()   # or run.future.add_done_callback(...)
+
+    The factory gets a ``step_funcs`` keyword with a reporter step function that it must pass to ``sim.run``
+    (``do_simrun`` does), and ``do_live=False`` if it takes ``do_live``. Results are converted like in
+    ``sweeps.run_point``, so ``(sim, refl, tran)`` comes back as flux spectra. Start as many runs as there are cores.
+    Runs are started with "spawn", because forking a kernel that has already run meep's threads can hang.
+    The factory must be picklable, so define it in a module, not in the notebook.
+'''
+import time
+import queue
+import asyncio
+import inspect
+import traceback
+import threading
+import multiprocessing
+from concurrent.futures import Future
+import numpy as np
+import meep as mp
+from sweeps import run_point, thread_budget
+
+
+class RunCancelled(Exception):
+    pass
+
+
+class ProgressReporter(object):
+    ''' Step function, in the worker, that sends progress and a downsampled field every ``interval`` seconds.
+        It also checks for cancellation, which stops ``sim.run`` by raising RunCancelled
+    '''
+    def __init__(self, messages, cancel_event, interval=2., component=mp.Ey, stride=4, end_time=None):
+        self.messages = messages
+        self.cancel_event = cancel_event
+        self.interval = interval
+        self.component = component
+        self.stride = stride
+        self.end_time = end_time
+        self.sim = None
+
+    def _slice(self, sim, component):
+        # x-y plane through the center, strided. 3D cells are cut at z = 0
+        size = mp.Vector3(sim.cell_size.x, sim.cell_size.y, 0)
+        arr = sim.get_array(center=mp.Vector3(), size=size, component=component)
+        return np.ascontiguousarray(np.atleast_2d(arr)[::self.stride, ::self.stride].transpose(), dtype=np.float32)
+
+    def _setup(self, sim):
+        self.sim = sim
+        half_x, half_y = sim.cell_size.x / 2, sim.cell_size.y / 2
+        self.messages.put(('setup', dict(extent=[-half_x, half_x, -half_y, half_y],
+                                         background=self._slice(sim, mp.Dielectric))))
+        self._t_start = self._t_last = time.time()
+        self._step_last, self._meep_last = sim.timestep(), sim.meep_time()
+        self._next_report = self._t_start
+
+    def __call__(self, sim):
+        if sim is not self.sim:
+            self._setup(sim)
+        now = time.time()
+        if now < self._next_report:
+            return
+        if self.cancel_event.is_set():
+            raise RunCancelled()
+        elapsed = max(now - self._t_last, 1e-9)
+        steps_per_second = (sim.timestep() - self._step_last) / elapsed
+        meep_per_second = (sim.meep_time() - self._meep_last) / elapsed
+        eta = None
+        if self.end_time is not None and meep_per_second and sim.meep_time() < self.end_time:
+            eta = (self.end_time - sim.meep_time()) / meep_per_second
+        self.messages.put(('progress', dict(meep_time=sim.meep_time(), timestep=sim.timestep(),
+                                            steps_per_second=steps_per_second, eta=eta, wall_time=now - self._t_start,
+                                            frame=self._slice(sim, self.component))))
+        self._t_last, self._step_last, self._meep_last = now, sim.timestep(), sim.meep_time()
+        self._next_report = now + self.interval
+
+    @property
+    def step(self):
+        ''' This reporter as a plain function. meep calls step functions by their argument count '''
+        def step(sim):
+            self(sim)
+        return step
+
+
+def _kernel_loop():
+    # the event loop of the notebook kernel, if this runs in one
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def _worker(factory, params, kwargs, messages, cancel_event, settings):
+    reporter = ProgressReporter(messages, cancel_event, interval=settings['interval'], component=settings['component'],
+                                stride=settings['stride'], end_time=settings['end_time'])
+    try:
+        result = run_point(factory, params, step_funcs=(reporter.step, ), **kwargs)
+    except RunCancelled:
+        messages.put(('cancelled', None))
+    except Exception:
+        # the exception itself might not pickle
+        messages.put(('error', RuntimeError(traceback.format_exc())))
+    else:
+        messages.put(('done', result))
+
+
+class BackgroundRun(object):
+    ''' Handle of one background simulation. Returned by ``launch`` '''
+    def __init__(self, name, process, messages, cancel_event):
+        self.name = name
+        self.process = process
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+        self.status = 'starting'
+        self.progress = dict(meep_time=0., timestep=0, steps_per_second=None, eta=None, wall_time=0.)
+        self.frame = None
+        self.extent = None
+        self.background = None
+        self.dashboards = []
+        self._loop = _kernel_loop()
+        self._messages = messages
+        self._cancel_event = cancel_event
+        self._listener = threading.Thread(target=self._listen, daemon=True)
+        self._listener.start()
+
+    def _listen(self):
+        # in a thread of the notebook process, so nothing here blocks the kernel
+        while True:
+            try:
+                kind, payload = self._messages.get(timeout=0.5)
+            except queue.Empty:
+                if self.process.is_alive():
+                    continue
+                # the last messages can arrive between the timeout and the exit
+                while True:
+                    try:
+                        kind, payload = self._messages.get_nowait()
+                    except (queue.Empty, EOFError, OSError):
+                        break
+                    if self._handle(kind, payload):
+                        return
+                if self._cancel_event.is_set():
+                    self._finish('cancelled', exception=RunCancelled(self.name))
+                else:
+                    self._finish('failed', exception=RuntimeError(
+                        '{} exited with code {}'.format(self.name, self.process.exitcode)))
+                return
+            except (EOFError, OSError) as err:
+                self._finish('failed', exception=err)
+                return
+            if self._handle(kind, payload):
+                return
+
+    def _handle(self, kind, payload):
+        # True once the run is over
+        if kind == 'setup':
+            self.extent, self.background = payload['extent'], payload['background']
+            self.status = 'running'
+        elif kind == 'progress':
+            self.frame = payload.pop('frame')
+            self.progress = payload
+            if self.dashboards and self._loop is not None:
+                # matplotlib belongs to the kernel thread, so the redraw is scheduled there
+                try:
+                    self._loop.call_soon_threadsafe(self._show_attached)
+                except RuntimeError:
+                    pass  # the loop is closed
+        elif kind == 'done':
+            self._finish('done', result=payload)
+        elif kind == 'cancelled':
+            self._finish('cancelled', exception=RunCancelled(self.name))
+        else:
+            self._finish('failed', exception=payload)
+        return kind not in ('setup', 'progress')
+
+    def _show_attached(self):
+        for dashboard in self.dashboards:
+            self.show(dashboard)
+
+    def _finish(self, status, result=None, exception=None):
+        self.status = status
+        if exception is None:
+            self.future.set_result(result)
+        else:
+            self.future.set_exception(exception)
+        self.process.join(timeout=5)
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        ''' Blocks until the run finishes. Raises RunCancelled if it was cancelled '''
+        return self.future.result(timeout)
+
+    def cancel(self, wait=True, timeout=10):
+        ''' Stops the run at its next report. If it does not stop within timeout, the process is terminated.
+            Either way the run ends as cancelled
+        '''
+        self._cancel_event.set()
+        if not wait:
+            return
+        try:
+            self.future.exception(timeout)
+        except Exception:
+            pass
+        if not self.done():
+            self.process.terminate()
+            self._listener.join(timeout=2)
+
+    def attach(self, dashboard):
+        ''' Shows every new snapshot in a panel of a ``meep_nb.LiveDashboard``. Works best with ``%matplotlib widget``.
+            Redraws run on the kernel's event loop. Outside a notebook kernel, call ``show`` instead
+        '''
+        self.dashboards.append(dashboard)
+
+    def show(self, dashboard):
+        ''' Puts the latest snapshot in a dashboard panel '''
+        if self.frame is None:
+            return
+        dashboard.update(self.name, self.frame, title='t = {:.1f}'.format(self.progress['meep_time']),
+                         extent=self.extent, background=self.background)
+
+    def __repr__(self):
+        line = '{}: {}'.format(self.name, self.status)
+        if self.status == 'running' and self.progress['steps_per_second'] is not None:
+            line += ', t = {:.1f}, {:.0f} steps/s'.format(self.progress['meep_time'], self.progress['steps_per_second'])
+            if self.progress['eta'] is not None:
+                line += ', ETA {:.0f} s'.format(self.progress['eta'])
+        return line
+
+
+def launch(factory, params=None, name=None, interval=2., component=mp.Ey, stride=4, cores_per_run=1,
+           mp_context=None, end_time=None, **kwargs):
+    ''' Starts ``factory`` in a new process and returns its ``BackgroundRun`` without waiting.
+
+        Args:
+            factory (callable): such as ``bragg_setups.do_simrun``. It must pass its ``step_funcs`` to ``sim.run``
+            params (dict or objview): like a sweep point. Keyword arguments also go to the factory
+            interval (float): wall-clock seconds between progress reports and field snapshots
+            component: field component of the snapshots
+            stride (int): downsampling of the snapshots
+            cores_per_run (int): thread budget of the process
+            mp_context (str): multiprocessing start method. Default is "spawn"
+            end_time (float): meep time the run is expected to reach, for the ETA. Default is ``until`` if it is
+                a number. Stop conditions such as field decay have no known end, so pass an estimate
+                (``bragg_setups.background_run`` does). There is no ETA without either, or once end_time is passed
+    '''
+    params = dict() if params is None else params
+    if 'do_live' in inspect.signature(factory).parameters:
+        kwargs['do_live'] = False  # no liveplot or notebook display in the worker. Use attach
+    if name is None:
+        name = 'run {}'.format(len(runs) + 1)
+    until = kwargs.get('until')
+    if end_time is None and isinstance(until, (int, float)):
+        end_time = until
+    settings = dict(interval=interval, component=component, stride=stride, end_time=end_time)
+    ctx = multiprocessing.get_context('spawn' if mp_context is None else mp_context)
+    messages = ctx.Queue()
+    cancel_event = ctx.Event()
+    process = ctx.Process(target=_worker, args=(factory, params, kwargs, messages, cancel_event, settings),
+                          name=name, daemon=True)
+    with thread_budget(cores_per_run):
+        process.start()
+    run = BackgroundRun(name, process, messages, cancel_event)
+    runs.append(run)
+    return run
+
+
+runs = []  # every run launched from this kernel
+
+
+def status():
+    ''' One line per launched run '''
+    for run in runs:
+        print(repr(run))
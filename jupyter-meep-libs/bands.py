@@ -0,0 +1,66 @@
+''' MPB band structures with the k-points split across processes.
+
+    k-points are independent, so the list is cut into contiguous chunks, one ModeSolver per chunk.
+    Within a chunk MPB starts each k-point from the previous one's eigenvectors, as in a serial run,
+    which is why the chunks are contiguous and not interleaved. Usage::
+
+        solver_kwargs = dict(geometry=geometry, geometry_lattice=geometry_lattice,
+                             resolution=32, num_bands=8)
+        all_freqs, parities = parallel_bands(solver_kwargs, k_points, run='run_te', parity='y')
+        gaps = band_gaps(all_freqs)  # like ms.gap_list
+
+    Scripts that call it must guard it with ``if __name__ == '__main__':``, because workers import the script.
+'''
+import os
+import numpy as np
+from sweeps import sweep_gather
+
+
+def _run_chunk(solver_kwargs, k_points, run='run', parity=None, band_funcs=()):
+    from meep import mpb
+    ms = mpb.ModeSolver(k_points=k_points, **solver_kwargs)
+    parities = []
+    def capture_parities(ms):
+        if parity == 'y':
+            parities.append(ms.compute_yparities())
+        elif parity == 'z':
+            parities.append(ms.compute_zparities())
+    getattr(ms, run)(capture_parities, *band_funcs)
+    return dict(all_freqs=np.array(ms.all_freqs), parities=np.array(parities))
+
+
+def parallel_bands(solver_kwargs, k_points, run='run', parity=None, band_funcs=(),
+                   n_workers=None, cores_per_worker=1):
+    ''' Equivalent to ``ModeSolver(k_points=k_points, **solver_kwargs).run(...)`` but in parallel.
+
+        Args:
+            solver_kwargs (dict): everything for ``mpb.ModeSolver`` except k_points. Must be picklable
+            k_points (list): of mp.Vector3, such as from ``mp.interpolate``
+            run (str): ModeSolver method, such as 'run', 'run_te', 'run_tm', 'run_yodd_zeven'
+            parity (str): 'y' or 'z' to also return compute_yparities/compute_zparities at every k-point
+            band_funcs (tuple): picklable MPB band functions, such as ``mpb.fix_efield_phase``
+
+        Returns:
+            (array, array): all_freqs, shape (len(k_points), num_bands), and parities (empty if parity is None)
+    '''
+    if n_workers is None:
+        n_workers = max(1, (os.cpu_count() or 1) // cores_per_worker)
+    n_chunks = max(1, min(n_workers, len(k_points)))
+    chunks = [[k_points[i] for i in indices] for indices in np.array_split(np.arange(len(k_points)), n_chunks)]
+    grid = [dict(k_points=chunk) for chunk in chunks if len(chunk) > 0]
+    results = sweep_gather(_run_chunk, grid, n_workers=n_chunks, cores_per_worker=cores_per_worker,
+                           solver_kwargs=solver_kwargs, run=run, parity=parity, band_funcs=band_funcs)
+    all_freqs = np.concatenate([res['all_freqs'] for res in results])
+    parities = np.concatenate([res['parities'] for res in results]) if parity is not None else np.array([])
+    return all_freqs, parities
+
+
+def band_gaps(all_freqs):
+    ''' Complete gaps between consecutive bands, as (gap percent, lower edge, upper edge) like ``ModeSolver.gap_list`` '''
+    all_freqs = np.asarray(all_freqs)
+    band_min, band_max = all_freqs.min(axis=0), all_freqs.max(axis=0)
+    gaps = []
+    for lower_top, upper_bottom in zip(band_max[:-1], band_min[1:]):
+        if upper_bottom > lower_top:
+            gaps.append((200 * (upper_bottom - lower_top) / (upper_bottom + lower_top), lower_top, upper_bottom))
+    return gaps
@@ -0,0 +1,307 @@
+''' Benchmarks of the library hot paths and the example setups, with a JSON history and baseline comparison.
+
+    Every benchmark runs at a few sizes and at small resolutions, so the whole suite takes minutes on a laptop.
+    From a terminal::
+
+        python benchmarks.py                    # run everything, append to the history
+        python benchmarks.py bragg get_ks       # only benchmarks whose names contain these
+        python benchmarks.py --save-baseline    # run, and make this run the baseline
+        python benchmarks.py --compare          # run, and compare with the baseline. Exit code 1 on regressions
+
+    From a notebook, ``compare(run_suite())``. Results live in ``~/.cache/jupyter-meep/benchmarks``
+    (or under JUPYTER_MEEP_CACHE): ``history.json`` has every run, ``baseline.json`` the baseline.
+    A benchmark whose dependencies are missing (such as phidl) is recorded as skipped.
+    One that raises anything else is recorded with its traceback under 'error', and the suite goes on.
+'''
+import os
+import sys
+import glob
+import gzip
+import json
+import time
+import pickle
+import platform
+import tempfile
+import traceback
+import subprocess
+import numpy as np
+from caching import default_cache_dir
+
+libs_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(libs_dir)
+for notebook_dir in ['Bragg', 'partial_waveguides']:
+    sys.path.append(os.path.join(repo_dir, 'notebooks', notebook_dir))
+
+benchmark_dir = os.path.join(default_cache_dir, 'benchmarks')
+history_file = os.path.join(benchmark_dir, 'history.json')
+baseline_file = os.path.join(benchmark_dir, 'baseline.json')
+
+registry = dict()
+
+
+def benchmark(*sizes):
+    ''' Registers ``func(size)`` to run at each size. It returns seconds, or a dict with 'seconds' and other metrics '''
+    def register(func):
+        registry[func.__name__] = (func, sizes)
+        return func
+    return register
+
+
+def best_time(func, repeat=3):
+    # minimum over repeats, which is the least noisy estimate
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+# --- Benchmarks
+
+@benchmark(5, 10, 20)
+def device_to_meep_loopmirror(R_exit):
+    from conversions import device_to_meep, get_layer_mapping
+    from phidl_examples import loop_mirror_terminator, lys
+    D = loop_mirror_terminator(R_exit=R_exit).flatten()
+    mapping = get_layer_mapping(lys)
+    return best_time(lambda: device_to_meep(D, mapping))
+
+
+@benchmark(1, 10, 100)
+def device_to_meep_mmi(n_mmis):
+    from conversions import device_to_meep, get_layer_mapping
+    from phidl_examples import mmi1x2, lys
+    from phidl import Device
+    D = Device('mmi_array')
+    mmi = mmi1x2()
+    for iMMI in range(n_mmis):
+        ref = D << mmi
+        ref.move((0, 3 * iMMI))
+    D.flatten()
+    mapping = get_layer_mapping(lys)
+    return best_time(lambda: device_to_meep(D, mapping))
+
+
+@benchmark(10, 30, 100)
+def bragg_init_sim(n_periods):
+    import meep as mp
+    import bragg_setups as bs
+    with bs.fidelity(resolution=10):
+        geo = bs.kwargs_to_geo(n_periods=n_periods)
+        geometry_time = best_time(lambda: bs.bragg_geometry(geo))
+        def init():
+            sim = mp.Simulation(**bs.sim_kwargs(geo))
+            sim.init_sim()
+        init_time = best_time(init, repeat=1)
+    return dict(seconds=geometry_time + init_time, geometry_seconds=geometry_time, init_seconds=init_time)
+
+
+@benchmark(10, 30)
+def bragg_steps_per_second(n_periods):
+    # the do_simrun path, with its monitors and stop condition. Only the time stepping phases are counted
+    import bragg_setups as bs
+    from profiling import RunProfile
+    with bs.fidelity(resolution=10, nfreq=101):
+        profile = RunProfile()
+        bs.do_simrun(do_live=False, geo=bs.kwargs_to_geo(n_periods=n_periods), until=20, profile=profile)
+    seconds = sum(profile.phases[name]['seconds'] for name in ['stepping', 'dft_monitors', 'callbacks', 'output'])
+    return dict(seconds=seconds, steps=profile.steps, steps_per_second=profile.steps / seconds)
+
+
+@benchmark(10, 20, 40)
+def liveplot_frame(resolution):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import meep as mp
+    from meep_nb import LiveView
+    sim = mp.Simulation(cell_size=mp.Vector3(16, 8), resolution=resolution, boundary_layers=[mp.PML(1)],
+                        geometry=[mp.Block(size=mp.Vector3(mp.inf, 1), material=mp.Medium(epsilon=12))],
+                        sources=[mp.Source(mp.ContinuousSource(0.15), component=mp.Ez, center=mp.Vector3(-6))],
+                        progress_interval=1e6)
+    sim.run(until=1)
+    view = LiveView(mp.Ez, min_interval=0, max_overhead=1)
+    view(sim)  # setup frame
+    n_frames = 20
+    view.draw_time, view.n_frames = 0., 0
+    for _ in range(n_frames):
+        view(sim)
+    plt.close('all')
+    return dict(seconds=view.draw_time / view.n_frames, frames=view.n_frames)
+
+
+@benchmark(16, 32)
+def get_ks(resolution):
+    import partial_wgs
+    old_resolution = partial_wgs.resolution
+    partial_wgs.resolution = resolution
+    try:
+        return best_time(partial_wgs.get_ks, repeat=1)
+    finally:
+        partial_wgs.resolution = old_resolution
+
+
+@benchmark('meep', 'meep_nb', 'conversions', 'sweeps', 'bragg_setups')
+def import_time(module_name):
+    # in a fresh interpreter, like a sweep worker. meep alone is the floor. Also lists the heavy modules it pulled in
+    code = ('import sys, time; t0 = time.perf_counter(); import {}; print(time.perf_counter() - t0); '
+            'print(",".join(m for m in ("matplotlib", "IPython", "phidl", "meep.mpb") if m in sys.modules))')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([libs_dir] + sys.path))
+    proc = subprocess.run([sys.executable, '-c', code.format(module_name)], cwd=libs_dir, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        raise ImportError(proc.stderr.strip().splitlines()[-1])
+    seconds, heavy = proc.stdout.strip('\n').split('\n')[-2:]
+    return dict(seconds=float(seconds), heavy_modules=heavy.split(',') if heavy else [])
+
+
+def _plain(obj):
+    # stand-in lightlab objects cannot be pickled again, so their state is saved as dicts
+    from results import _LightlabStandIn
+    if isinstance(obj, _LightlabStandIn):
+        return {k: _plain(v) for k, v in vars(obj).items()}
+    if isinstance(obj, type) and issubclass(obj, _LightlabStandIn):
+        return obj.__name__
+    if isinstance(obj, dict):
+        return {k: _plain(v) for k, v in obj.items()}
+    if isinstance(obj, (tuple, list)):
+        return type(obj)(_plain(item) for item in obj)
+    return obj
+
+
+@benchmark(*sorted(os.path.basename(fname) for fname in glob.glob(os.path.join(repo_dir, 'data', '*.pkl.gz'))))
+def pickle_gzip(basename):
+    from results import _StandInUnpickler  # lightlab does not need to be installed
+    filename = os.path.join(repo_dir, 'data', basename)
+    def load():
+        with gzip.open(filename, 'rb') as fx:
+            return _StandInUnpickler(fx).load()
+    load_time = best_time(load)
+    contents = _plain(load())
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        def save():
+            with gzip.open(os.path.join(tmp_dir, basename), 'wb') as fx:
+                pickle.dump(contents, fx)
+        save_time = best_time(save)
+    return dict(seconds=load_time + save_time, load_seconds=load_time, save_seconds=save_time,
+                bytes=os.path.getsize(filename))
+
+
+# --- Running, history and comparison
+
+def _versions():
+    versions = dict(python=platform.python_version(), numpy=np.__version__)
+    for module_name in ['meep', 'phidl']:
+        try:
+            versions[module_name] = __import__(module_name).__version__
+        except Exception:
+            versions[module_name] = None
+    return versions
+
+
+def run_suite(names=None, verbose=True):
+    ''' Runs the benchmarks whose names contain any of ``names`` (default all). Returns a run record '''
+    results = []
+    for name, (func, sizes) in registry.items():
+        if names and not any(pattern in name for pattern in names):
+            continue
+        for size in sizes:
+            record = dict(name=name, size=size)
+            try:
+                outcome = func(size)
+            except ImportError as err:
+                record['skipped'] = str(err)
+                if verbose:
+                    print('{:<28} {:>28}   skipped ({})'.format(name, str(size), err))
+                results.append(record)
+                break
+            except Exception as err:
+                # such as a meep error or a missing data file. The other benchmarks still run
+                record['error'] = traceback.format_exc()
+                if verbose:
+                    print('{:<28} {:>28}   failed ({})'.format(name, str(size), repr(err)))
+                results.append(record)
+                continue
+            record.update(outcome if isinstance(outcome, dict) else dict(seconds=outcome))
+            if verbose:
+                print('{:<28} {:>28} {:>10.4f} s'.format(name, str(size), record['seconds']))
+            results.append(record)
+    return dict(timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'), host=platform.node(),
+                versions=_versions(), results=results)
+
+
+def _load(filename, default):
+    if not os.path.isfile(filename):
+        return default
+    with open(filename) as fx:
+        return json.load(fx)
+
+
+def _dump(obj, filename):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'w') as fx:
+        json.dump(obj, fx, indent=1)
+    os.replace(tmp_file, filename)
+
+
+def save_run(run, filename=None):
+    # appends to the history
+    filename = filename or history_file
+    history = _load(filename, [])
+    history.append(run)
+    _dump(history, filename)
+
+
+def load_history(filename=None):
+    return _load(filename or history_file, [])
+
+
+def save_baseline(run, filename=None):
+    _dump(run, filename or baseline_file)
+
+
+def compare(run, baseline=None, threshold=1.2, min_seconds=0.01, verbose=True):
+    ''' Ratios of run to baseline seconds for every (name, size) in both.
+        Returns the list of regressions: entries slower than threshold times the baseline,
+        and by more than min_seconds, so that timer noise on very fast entries is not counted
+    '''
+    if baseline is None:
+        baseline = _load(baseline_file, None)
+        if baseline is None:
+            raise FileNotFoundError('No baseline yet. Save one with save_baseline(run) or --save-baseline')
+    base_seconds = {(res['name'], str(res['size'])): res['seconds'] for res in baseline['results'] if 'seconds' in res}
+    regressions = []
+    for res in run['results']:
+        key = (res['name'], str(res['size']))
+        if 'seconds' not in res or key not in base_seconds:
+            continue
+        ratio = res['seconds'] / base_seconds[key]
+        flag = ''
+        if ratio > threshold and res['seconds'] - base_seconds[key] > min_seconds:
+            flag = 'SLOWER'
+            regressions.append(dict(name=key[0], size=key[1], ratio=ratio))
+        elif ratio < 1 / threshold and base_seconds[key] - res['seconds'] > min_seconds:
+            flag = 'faster'
+        if verbose:
+            print('{:<28} {:>28} {:>10.4f} s {:>6.2f}x {}'.format(key[0], key[1], res['seconds'], ratio, flag))
+    if verbose:
+        print('{} regressions against the baseline from {}'.format(len(regressions), baseline['timestamp']))
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmarks of jupyter-meep-libs and the example setups')
+    parser.add_argument('names', nargs='*', help='only run benchmarks whose names contain these')
+    parser.add_argument('--save-baseline', action='store_true', help='make this run the baseline')
+    parser.add_argument('--compare', action='store_true', help='compare with the baseline')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio counted as a regression')
+    args = parser.parse_args()
+    this_run = run_suite(args.names)
+    save_run(this_run)
+    if args.save_baseline:
+        save_baseline(this_run)
+    if args.compare and len(compare(this_run, threshold=args.threshold)) > 0:
+        sys.exit(1)
@@ -0,0 +1,149 @@
+''' Content-keyed on-disk caches for conversion and simulation results.
+
+    Entries are npz files named by a hash of everything that determines them.
+    Each cache directory is bounded in size and evicts the least recently used entries.
+    Set the environment variable JUPYTER_MEEP_CACHE to move the caches somewhere else.
+'''
+import os
+import json
+import hashlib
+import numpy as np
+
+
+default_cache_dir = os.environ.get('JUPYTER_MEEP_CACHE',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'jupyter-meep'))
+
+
+def hash_file(filename, chunk_size=1 << 20):
+    # sha256 of the file contents, so renames and touches do not invalidate
+    hasher = hashlib.sha256()
+    with open(filename, 'rb') as fx:
+        for chunk in iter(lambda: fx.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def hash_key(*parts):
+    # Stable hash of json-able parts. Things that are not json-able are hashed by repr
+    text = json.dumps(parts, sort_keys=True, default=repr)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class DiskCache(object):
+    ''' A directory of npz files with LRU eviction.
+
+        Values are dicts of numpy arrays. Access time is tracked by file modification time,
+        so the cache survives kernel restarts and is shared between processes.
+    '''
+    def __init__(self, name, max_bytes=500e6, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = default_cache_dir
+        self.directory = os.path.join(cache_dir, name)
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def __contains__(self, key):
+        return os.path.isfile(self._path(key))
+
+    def get(self, key):
+        ''' Returns a dict of arrays or None if missing '''
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                arrays = {k: npz[k] for k in npz.files}
+        except (OSError, ValueError):
+            return None
+        os.utime(path)  # mark as recently used
+        return arrays
+
+    def put(self, key, arrays):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp_path = path + '.{}.tmp'.format(os.getpid())
+        with open(tmp_path, 'wb') as fx:
+            np.savez(fx, **arrays)
+        os.replace(tmp_path, path)  # atomic, in case other processes are reading
+        self.evict()
+
+    def entries(self):
+        # (path, size, mtime) of every entry, oldest first
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for fname in os.listdir(self.directory):
+            if not fname.endswith('.npz'):
+                continue
+            path = os.path.join(self.directory, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda ent: ent[2])
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(ent[1] for ent in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            os.remove(path)
+
+
+flux_reference_cache = DiskCache('flux_reference', max_bytes=2e9)
+
+
+def cached_flux_reference(run_reference, key_parts, use_cache=True, cache=None):
+    ''' Normalization run for reflection/transmission, cached on disk.
+
+        Args:
+            run_reference (callable): no arguments, runs the straight waveguide and returns ``(sim, refl, tran)``
+            key_parts (tuple): everything that determines the reference, such as cell, source, monitors, resolution, nfreq
+            use_cache (bool): False forces a rerun (and refreshes the entry)
+
+        Returns:
+            (FluxData, array): ``sim.get_flux_data(refl)`` for ``load_minus_flux_data``,
+            and ``mp.get_fluxes(tran)`` for normalizing power
+    '''
+    import meep as mp
+    if cache is None:
+        cache = flux_reference_cache
+    key = hash_key('flux_reference-v1', key_parts)
+    arrays = cache.get(key) if use_cache else None
+    if arrays is None:
+        sim, refl, tran = run_reference()
+        refl_data = sim.get_flux_data(refl)
+        arrays = dict(refl_E=np.asarray(refl_data.E), refl_H=np.asarray(refl_data.H),
+                      tran_flux=np.array(mp.get_fluxes(tran)))
+        cache.put(key, arrays)
+    refl_data = mp.simulation.FluxData(E=arrays['refl_E'], H=arrays['refl_H'])
+    return refl_data, arrays['tran_flux']
+
+
+def cached_timeseries_reference(run_reference, key_parts, freqs, use_cache=True, cache=None):
+    ''' Like ``cached_flux_reference``, for ``spectra.TimeSeriesMonitor`` monitors.
+
+        Returns:
+            (tuple, array): the reflection monitor's ``(times, values)`` for its ``load_minus``,
+            and the transmission monitor's spectrum at freqs for normalizing power
+    '''
+    if cache is None:
+        cache = flux_reference_cache
+    key = hash_key('timeseries_reference-v1', key_parts, list(freqs))
+    arrays = cache.get(key) if use_cache else None
+    if arrays is None:
+        sim, refl, tran = run_reference()
+        refl_times, refl_values = refl.series()
+        arrays = dict(refl_times=refl_times, refl_values=refl_values, tran_spectrum=tran.spectrum(freqs))
+        cache.put(key, arrays)
+    return (arrays['refl_times'], arrays['refl_values']), arrays['tran_spectrum']
@@ -1,12 +1,17 @@
+import time
 import numpy as np
-from phidl import geometry as pg, path as pp, Device, Layer, LayerSet, CrossSection, Path
 import meep as mp
+from caching import DiskCache, hash_file, hash_key
+# phidl is imported where it is used, so that simulation workers given polygons or gds caches do not load it
 
 silicon = mp.Medium(epsilon=12)
 cell_material = dict()  # for floorplanning
 port_source = dict()  # for metadata layers
 LAYER_SOURCE = 1
 LAYER_PORT = 2
+LAYER_SHALLOW = 21  # the gds layers of the phidl_examples LayerSet
+LAYER_DEEP = 22
+LAYER_FLOORPLAN = 99
 
 def get_layer_mapping(layerset):
     # Gets the silicon layer and the floorplan layer for the cell
@@ -18,10 +23,11 @@ def get_layer_mapping(layerset):
     return medium_map
 
 
-def device_to_meep(device, mapping):
-    # converts PHIDL to MEEP. You must give a layer mapping that can be derived from get_layer_mapping
-    # TODO: partial etches. Currently this is only 2D
-    geometry = list()
+def device_to_polygons(device, mapping):
+    # Groups the numpy vertex arrays phidl already holds by gds layer. No MEEP objects are created here.
+    # Returns the cell size as a tuple and a dict of {layer: [array(N, 2), ...]}
+    cell = None
+    layer_polys = dict()
     for poly_grp in device.polygons:
         layer = poly_grp.layers[0]
         try:
@@ -30,28 +36,329 @@ def device_to_meep(device, mapping):
             print('layer {} not in meep mapping'.format(layer))
             continue
         if material is cell_material:
-            cell = mp.Vector3(poly_grp.xsize, poly_grp.ysize)
+            cell = (poly_grp.xsize, poly_grp.ysize)
             continue
         elif material is port_source:
             continue
-        for poly in poly_grp.polygons:
-            vertex_list = list()
-            for vertex in poly:
-                vertex_list.append(mp.Vector3(vertex[0], vertex[1]))
-            geometry.append(mp.Prism(vertex_list, height=0, material=material))
+        layer_polys.setdefault(layer, []).extend(np.asarray(poly, dtype=float) for poly in poly_grp.polygons)
+    return cell, layer_polys
+
+
+def polygons_to_meep(layer_polys, mapping, height=0, z_base=0, sidewall_angle=0):
+    # Batches prism creation per layer: one concatenated vertex array and one tolist per layer
+    # sidewall_angle is in degrees, positive for sidewalls that lean inward going up
+    prism_kwargs = dict(sidewall_angle=np.radians(sidewall_angle)) if sidewall_angle else dict()
+    geometry = list()
+    for layer, polys in layer_polys.items():
+        if len(polys) == 0:
+            continue
+        material = mapping[layer]
+        flat = np.concatenate(polys).tolist()
+        vectors = [mp.Vector3(x, y, z_base) for x, y in flat]
+        splits = np.cumsum([0] + [len(poly) for poly in polys]).tolist()
+        geometry.extend(mp.Prism(vectors[i0:i1], height=height, material=material, **prism_kwargs)
+                        for i0, i1 in zip(splits[:-1], splits[1:]))
+    return geometry
+
+
+# --- 3D layer stacks
+
+SiO2 = mp.Medium(index=1.45)
+
+
+def layer_spec(material=silicon, z_base=0, thickness=0.220, sidewall_angle=0):
+    # One gds layer of a stack: extruded from z_base up by thickness. sidewall_angle in degrees
+    return dict(material=material, z_base=z_base, thickness=thickness, sidewall_angle=sidewall_angle)
+
+
+def partial_etch_stack(t_si=0.220, t_ped=0.050, material=silicon, sidewall_angle=0):
+    ''' The rib-on-pedestal stack of notebooks/partial_waveguides (same t_si, t_ped defaults).
+        wg_deep (22) is the full-thickness rib. wg_shallow (21) is the pedestal left by the partial etch.
+        Both sit on the BOX top at z=0. Put the BOX in with ``stack_substrate``
+    '''
+    return {LAYER_DEEP: layer_spec(material, 0, t_si, sidewall_angle),
+            LAYER_SHALLOW: layer_spec(material, 0, t_ped, sidewall_angle)}
+
+
+def stack_substrate(t_box=1.2, material=SiO2):
+    # The BOX under z=0, as in partial_wgs.get_xs. The cladding is the simulation default_material
+    return [mp.Block(size=mp.Vector3(mp.inf, mp.inf, t_box), center=mp.Vector3(z=-t_box / 2), material=material)]
+
+
+def _contains(outer, inner):
+    # True if layer spec outer fills the whole volume of inner wherever they overlap in the plane
+    return (outer['material'] is inner['material'] and not outer['sidewall_angle']
+            and outer['z_base'] <= inner['z_base']
+            and outer['z_base'] + outer['thickness'] >= inner['z_base'] + inner['thickness'])
+
+
+def merge_stack_polygons(layer_polys, stack, precision=1e-4):
+    ''' Removes overlapping duplicates before extrusion. Each layer is unioned, then the parts of it that lie
+        inside a thicker layer of the same material are cut away. A rib on a pedestal becomes the rib prism plus
+        the pedestal on either side of it, not a pedestal with a rib overlapping it.
+    '''
+    import gdspy
+    merged = dict()
+    for layer, polys in layer_polys.items():
+        if len(polys) == 0 or layer not in stack:
+            continue
+        result = gdspy.boolean(polys, None, 'or', precision=precision)
+        for other, other_polys in layer_polys.items():
+            if result is None:
+                break
+            if other == layer or other not in stack or len(other_polys) == 0:
+                continue
+            if _contains(stack[other], stack[layer]) and not (_contains(stack[layer], stack[other]) and other > layer):
+                result = gdspy.boolean(result, other_polys, 'not', precision=precision)
+        merged[layer] = [] if result is None else [np.asarray(poly) for poly in result.polygons]
+    return merged
+
+
+def stack_to_meep(layer_polys, stack, merge=True, slab_neff=None):
+    # Extrudes every layer of the stack. Layers without a spec are left out.
+    # With slab_neff (a function of thickness), the geometry is instead 2D, each layer with its slab effective index
+    if merge:
+        layer_polys = merge_stack_polygons(layer_polys, stack)
+    geometry = list()
+    for layer, spec in stack.items():
+        if layer not in layer_polys:
+            continue
+        if slab_neff is None:
+            geometry.extend(polygons_to_meep({layer: layer_polys[layer]}, {layer: spec['material']},
+                                             height=spec['thickness'], z_base=spec['z_base'],
+                                             sidewall_angle=spec['sidewall_angle']))
+        else:
+            medium = mp.Medium(index=slab_neff(spec['thickness']))
+            geometry.extend(polygons_to_meep({layer: layer_polys[layer]}, {layer: medium}))
+    return geometry
+
+
+def _stack_mapping(mapping, stack):
+    if stack is None:
+        return mapping
+    return {**mapping, **{layer: spec['material'] for layer, spec in stack.items()}}
+
+
+def _to_geometry(layer_polys, mapping, stack, slab_neff=None):
+    if stack is None:
+        return polygons_to_meep(layer_polys, mapping)
+    return stack_to_meep(layer_polys, stack, slab_neff=slab_neff)
+
+
+def decimate_polygon(poly, tol):
+    # Ramer-Douglas-Peucker on a closed polygon. Drops vertices within tol of the simplified outline
+    n_verts = len(poly)
+    if n_verts <= 4 or tol <= 0:
+        return poly
+    far = int(np.argmax(np.sum((poly - poly[0]) ** 2, axis=1)))
+    closed = np.vstack([poly, poly[:1]])
+    keep = np.zeros(n_verts, dtype=bool)
+    keep[[0, far]] = True
+    stack = [(0, far), (far, n_verts)]
+    while stack:
+        i0, i1 = stack.pop()
+        if i1 - i0 < 2:
+            continue
+        a, b = closed[i0], closed[i1]
+        pts = closed[i0 + 1:i1]
+        ab = b - a
+        length = np.hypot(*ab)
+        if length == 0:
+            dist = np.hypot(*(pts - a).T)
+        else:
+            dist = np.abs(ab[0] * (pts[:, 1] - a[1]) - ab[1] * (pts[:, 0] - a[0])) / length
+        imax = int(np.argmax(dist))
+        if dist[imax] > tol:
+            imid = i0 + 1 + imax
+            keep[imid] = True
+            stack.extend([(i0, imid), (imid, i1)])
+    return poly[keep] if np.count_nonzero(keep) >= 3 else poly
+
+
+def simplify_polygons(layer_polys, tol, merge=True):
+    # Merges touching polygons on the same layer, then decimates vertices to tol (in um).
+    # Returns new layer_polys and a dict of vertices removed and prisms before and after
+    import gdspy
+    new_polys = dict()
+    stats = dict(vertices_removed=0, prisms_before=0, prisms_after=0)
+    for layer, polys in layer_polys.items():
+        n_before = sum(len(poly) for poly in polys)
+        if merge and len(polys) > 1:
+            # max_points=0 so that long merged outlines are not fractured into pieces again
+            merged = gdspy.boolean(polys, None, 'or', precision=max(tol / 10, 1e-4), max_points=0)
+            merged_polys = [] if merged is None else merged.polygons
+        else:
+            merged_polys = polys
+        new_polys[layer] = [decimate_polygon(np.asarray(poly, dtype=float), tol) for poly in merged_polys]
+        stats['vertices_removed'] += n_before - sum(len(poly) for poly in new_polys[layer])
+        stats['prisms_before'] += len(polys)
+        stats['prisms_after'] += len(new_polys[layer])
+    return new_polys, stats
+
+
+def _prepared_polygons(device, mapping, resolution=None, pixel_tol=0.25, merge=True):
+    cell, layer_polys = device_to_polygons(device, mapping)
+    if resolution is not None:
+        layer_polys, stats = simplify_polygons(layer_polys, pixel_tol / resolution, merge=merge)
+        print('Simplified geometry: removed {vertices_removed} vertices, '
+              '{prisms_before} prisms became {prisms_after}'.format(**stats))
+    return cell, layer_polys
+
+
+def crop_cell(cell, layer_polys, margin):
+    # Shrinks the cell to the geometry extent plus margin (such as PML + padding) on every side.
+    # The cell stays centered on the origin, because sources and monitors are placed in device coordinates.
+    # So the crop is symmetric: each half of the cell keeps the larger of the device's extents on the two sides,
+    # and a device off to one side of its origin saves little. Center such devices on the origin first
+    all_verts = np.concatenate([poly for polys in layer_polys.values() for poly in polys])
+    half_extent = np.max(np.abs(all_verts), axis=0) + margin
+    cropped = 2 * half_extent
+    if cell is not None:
+        cropped = np.minimum(cropped, cell)
+    return tuple(cropped.tolist())
+
+
+def port_polygons(device, mapping):
+    # Polygons on the source and port metadata layers
+    polys = []
+    for poly_grp in device.polygons:
+        if mapping.get(poly_grp.layers[0]) is port_source:
+            polys.extend(np.asarray(poly, dtype=float) for poly in poly_grp.polygons)
+    return polys
+
+
+def _is_mirror_symmetric(polys, direction, rel_tol):
+    import gdspy
+    if len(polys) == 0:
+        return True
+    flip = np.array([-1, 1]) if direction == mp.X else np.array([1, -1])
+    mismatch = gdspy.boolean(polys, [poly * flip for poly in polys], 'xor', precision=1e-4)
+    if mismatch is None:
+        return True
+    total_area = sum(gdspy.Polygon(poly).area() for poly in polys)
+    return mismatch.area() <= rel_tol * total_area
+
+
+def mirror_phase(direction, component):
+    # Phase of a mirror symmetry for a source with an even spatial profile.
+    # E is a vector: its component normal to the mirror flips. H is a pseudovector: the other two flip
+    e_components = {mp.X: mp.Ex, mp.Y: mp.Ey, mp.Z: mp.Ez}
+    h_components = {mp.X: mp.Hx, mp.Y: mp.Hy, mp.Z: mp.Hz}
+    if component in e_components.values():
+        return -1 if component == e_components[direction] else 1
+    return 1 if component == h_components[direction] else -1
+
+
+def device_symmetries(device, mapping, component=mp.Ez, rel_tol=1e-3):
+    ''' Mirror symmetries of the flattened device about the origin (the center of the MEEP cell).
+        The geometry on every material layer, and the source/port rectangles, must be symmetric.
+        component is the source component, which sets the phase of each mp.Mirror.
+        Give the result to mp.Simulation(symmetries=...)
+    '''
+    _, layer_polys = device_to_polygons(device, mapping)
+    groups = list(layer_polys.values()) + [port_polygons(device, mapping)]
+    symmetries = []
+    for direction in [mp.X, mp.Y]:
+        if all(_is_mirror_symmetric(polys, direction, rel_tol) for polys in groups):
+            symmetries.append(mp.Mirror(direction, phase=mirror_phase(direction, component)))
+    return symmetries
+
+
+def device_to_meep(device, mapping, verbose=False, resolution=None, pixel_tol=0.25, merge=True, crop_margin=None,
+                   stack=None, slab_neff=None):
+    # converts PHIDL to MEEP. You must give a layer mapping that can be derived from get_layer_mapping
+    # If resolution is given, polygons are simplified to within pixel_tol pixels and touching ones are merged
+    # If crop_margin is given, the cell is cropped to the geometry plus that margin, symmetrically about the origin
+    # (see crop_cell). See also device_symmetries
+    # If stack is given (such as partial_etch_stack()), the geometry is 3D. The returned cell is still 2D:
+    # set its z size, and add stack_substrate() to the geometry.
+    # If slab_neff is also given (such as partial_wgs.slab_neff), the stack is collapsed to 2D by the effective index
+    # method: every region gets the index of the vertical slab mode of its thickness
+    t0 = time.time()
+    mapping = _stack_mapping(mapping, stack)
+    cell, layer_polys = _prepared_polygons(device, mapping, resolution, pixel_tol, merge)
+    if crop_margin is not None:
+        cell = crop_cell(cell, {'ports': port_polygons(device, mapping), **layer_polys}, crop_margin)
+    geometry = _to_geometry(layer_polys, mapping, stack, slab_neff)
+    if verbose:
+        n_verts = sum(len(poly) for polys in layer_polys.values() for poly in polys)
+        print('Converted {} prisms ({} vertices) in {:.1f} ms'.format(len(geometry), n_verts, 1e3 * (time.time() - t0)))
+    if cell is not None:
+        cell = mp.Vector3(*cell)
     return cell, geometry
 
 
-def gds_to_meep(filename):
-    D = Device('gdsext')
-    D.load_gds(filename)
-    D.flatten()
-    return device_to_meep(D)
+gds_cache = DiskCache('gds', max_bytes=200e6)
+
+
+def _mapping_roles(mapping):
+    # The part of the mapping that determines the polygons. Materials themselves are applied after the cache
+    roles = []
+    for layer, material in mapping.items():
+        role = 'cell' if material is cell_material else 'port' if material is port_source else 'medium'
+        roles.append([layer, role])
+    return sorted(roles)
+
+
+def _pack_polygons(cell, layer_polys, ports):
+    # ports are kept for crop_cell, as 'verts_ports'
+    arrays = dict(cell=np.array([] if cell is None else cell, dtype=float))
+    for layer, polys in list(layer_polys.items()) + [('ports', ports)]:
+        arrays['verts_{}'.format(layer)] = np.concatenate(polys) if len(polys) > 0 else np.zeros((0, 2))
+        arrays['lens_{}'.format(layer)] = np.array([len(poly) for poly in polys], dtype=int)
+    return arrays
+
+
+def _unpack_polygons(arrays):
+    cell = tuple(arrays['cell'].tolist()) if len(arrays['cell']) > 0 else None
+    layer_polys = dict()
+    for name in arrays.keys():
+        if not name.startswith('verts_'):
+            continue
+        layer = name[len('verts_'):]
+        lens = arrays['lens_{}'.format(layer)]
+        layer = layer if layer == 'ports' else int(layer)
+        layer_polys[layer] = np.split(arrays[name], np.cumsum(lens)[:-1]) if len(lens) > 0 else []
+    ports = layer_polys.pop('ports', [])
+    return cell, layer_polys, ports
+
+
+def gds_to_meep(filename, mapping, use_cache=True, verbose=False, resolution=None, pixel_tol=0.25, merge=True,
+                crop_margin=None, stack=None, slab_neff=None):
+    # Like device_to_meep but from a file. The converted polygons are cached on disk,
+    # keyed by the file contents, the layer mapping, and the simplification settings
+    t0 = time.time()
+    mapping = _stack_mapping(mapping, stack)
+    key = hash_key('gds_to_meep-v2', hash_file(filename), _mapping_roles(mapping),
+                   resolution, pixel_tol if resolution is not None else None, merge)
+    arrays = gds_cache.get(key) if use_cache else None
+    if arrays is None:
+        from phidl import Device
+        D = Device('gdsext')
+        D.load_gds(filename)
+        D.flatten()
+        cell, layer_polys = _prepared_polygons(D, mapping, resolution, pixel_tol, merge)
+        ports = port_polygons(D, mapping)
+        if use_cache:
+            gds_cache.put(key, _pack_polygons(cell, layer_polys, ports))
+    else:
+        cell, layer_polys, ports = _unpack_polygons(arrays)
+    if crop_margin is not None:
+        cell = crop_cell(cell, {'ports': ports, **layer_polys}, crop_margin)
+    geometry = _to_geometry(layer_polys, mapping, stack, slab_neff)
+    if verbose:
+        print('{} {} in {:.1f} ms'.format('Loaded from cache' if arrays is not None else 'Converted',
+                                        filename, 1e3 * (time.time() - t0)))
+    if cell is not None:
+        cell = mp.Vector3(*cell)
+    return cell, geometry
 
 
 def put_cell_on_reflector(reflector_device, entry_length=8, cell_buffer=1):
     ''' Returns a Device with a simulation cell and ports placed around a Device
         That has one port called wg_in_1 '''
+    from phidl import Device, geometry as pg
+    from phidl_examples import default_wgX
     D = Device('Simulation Cell')
     entry = D << default_wgX.extrude(entry_length)
     entry.y = 0
@@ -62,7 +369,7 @@ def put_cell_on_reflector(reflector_device, entry_length=8, cell_buffer=1):
     sim_cell = D << pg.bbox([
         [entry.xmin, ref.ymin - cell_buffer],
         [ref.xmax + cell_buffer, ref.ymax + cell_buffer]
-    ], layer=lys['FLOORPLAN'])
+    ], layer=LAYER_FLOORPLAN)
     source = D << pg.rectangle([.1, 1], layer=LAYER_SOURCE)
     source.y = entry.y
     source.x = entry.xmin + 1
@@ -72,88 +379,12 @@ def put_cell_on_reflector(reflector_device, entry_length=8, cell_buffer=1):
     return D.flatten()
 
 
-# --- Examples of creating geometry with phidl and converting to MEEP
-
-lys = LayerSet()
-lys.add_layer('wg_shallow', gds_layer=21)
-lys.add_layer('wg_deep', gds_layer=22)
-lys.add_layer('FLOORPLAN', gds_layer=99)
-
-default_wgX = CrossSection().add(0.35, layer=lys['wg_deep'], ports=('in', 'out'), name='Rib')
-
-def mmi1x2(length_port=0.2, length_mmi=2.8, width_mmi=1.55, gap_mmi=0.65):
-    D=Device('MMI')
-    wg_width = default_wgX['Rib']['width']
-    body = D << pg.compass((length_mmi, width_mmi), layer=lys['wg_deep'])
-    Port_wg = pg.compass((length_port, wg_width), layer=lys['wg_deep'])
-    port_in = D << Port_wg
-    port_out1 = D << Port_wg
-    port_out2 = D << Port_wg
-    port_in.connect('E', body.ports['W'])
-    port_out1.connect('W', body.ports['E'])
-    port_out2.connect('W', body.ports['E'])
-    port_out1.y += (wg_width + gap_mmi) / 2
-    port_out2.y -= (wg_width + gap_mmi) / 2
-
-    D.add_port('wg_in_1', port=port_in.ports['W'])
-    D.add_port('wg_out_1', port=port_out1.ports['E'])
-    D.add_port('wg_out_2', port=port_out2.ports['E'])
-    D.flatten()
-    return D
-
-def loop_mirror_terminator(y_splitter=None, theta_exit=35, R_exit=5, R_min_check=3):
-    ''' A loop mirror (or Sagnac interferometer) consisting of a splitter with connected outputs.
-        Performance should be pretty broad band, determined by the MMI.
-
-        The only port is 'wg_in_1'
-    '''
-    if R_exit < R_min_check:
-        raise ValueError('Exit radius cannot be less than specified minimum radius [{:.3f} < {}]'.format(R_exit, R_min_check))
-    D = Device('LoopMirror')
-    if y_splitter is None:
-        y_splitter = mmi1x2()
-    split = D << y_splitter
-
-    P_exit = pp.euler(radius=R_exit, angle=theta_exit, p=.7)
-    loop_arcangle = 180 + 2*theta_exit
-    dy = abs(split.ports['wg_out_1'].y - split.ports['wg_out_2'].y) / 2
-    dy += P_exit.ysize
-    Reff = dy / np.cos(np.pi / 180 * theta_exit)
-
-    P_loop = pp.euler(radius=Reff, angle=-loop_arcangle, p=.3, use_eff=True)
-    if P_loop.info['Rmin'] < R_min_check:
-        raise ValueError('Loop radius is too tight [{:.3f} < {}]. Try increasing theta_exit or R_exit'.format(P_loop.info['Rmin'], R_min_check))
-    loop = D << Path([P_exit, P_loop, P_exit]).extrude(default_wgX)
-    loop.connect('in', split.ports['wg_out_1'])
-    assert np.allclose(loop.ports['out'].midpoint, split.ports['wg_out_2'].midpoint)  # Math check
-
-    D.add_port('wg_in_1', port=split.ports['wg_in_1'])
-    return D
-
-def give_loopmirror(gap_mmi=.5):
-    # just an example of augmenting a normal phidl device (loop_mirror_terminator)
-    # giving it as a phidl Device as well as port, bounding box, and source things used by MEEP
-    D = Device('loopmirror')
-
-    cell = D << pg.rectangle([31, 15], layer=lys['FLOORPLAN'])
-    cell.center = (0, 0)
-
-    access = D << pg.compass([8, .35], layer=lys['wg_deep'])
-    access.y = cell.y
-    access.xmin = cell.xmin
-
-    mmi = mmi1x2(gap_mmi=.5)
-    loop = D << loop_mirror_terminator(y_splitter=mmi)
-    loop.connect('wg_in_1', access.ports['E'])
-
-    # medium_map = get_layer_mapping(lys)
-
-    port = D << pg.rectangle([.1, 1], layer=1)
-    source = D << pg.rectangle([.1, 1], layer=2)
-    port.y = 0
-    source.y = 0
-    port.x = loop.xmin - 6
-    source.x = loop.xmin - 7
-
-    D.flatten()
-    return D
+_example_names = ('lys', 'default_wgX', 'mmi1x2', 'loop_mirror_terminator', 'give_loopmirror')
+
+
+def __getattr__(name):
+    # The examples live in phidl_examples, so they are only built when asked for. They can still be imported from here
+    if name in _example_names:
+        import phidl_examples
+        return getattr(phidl_examples, name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -0,0 +1,25 @@
+''' Deferred imports for heavy optional dependencies (matplotlib, IPython, MPB, phidl).
+
+    ``plt = lazy_import('matplotlib.pyplot')`` binds a name that imports the module on first attribute access.
+    Headless sweep workers import the library modules once per process, so they only pay for what they use.
+'''
+import importlib
+
+
+class LazyModule(object):
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return '<lazy module {!r} ({})>'.format(self._name, state)
+
+
+def lazy_import(name):
+    return LazyModule(name)
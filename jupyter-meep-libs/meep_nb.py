@@ -1,16 +1,20 @@
 import meep as mp
 
+import time
 import numpy as np
-import matplotlib.pyplot as plt
 import subprocess
-import inspect
-import shutil
 import os
-from functools import wraps
-from IPython import display
-from IPython.utils.capture import capture_output
-import meep as mp
-from meep import mpb, materials
+import hashlib
+import weakref
+from movies import open_movie, colormap_palette, to_indices
+from preview import preview_epsilon
+from lazy import lazy_import
+# plotting, notebook display and MPB load on first use, so headless workers (such as sweeps) skip them
+matplotlib = lazy_import('matplotlib')
+plt = lazy_import('matplotlib.pyplot')
+display = lazy_import('IPython.display')
+mpb = lazy_import('meep.mpb')
+materials = lazy_import('meep.materials')
 
 silicon = mp.Medium(epsilon=12)
 oxide = mp.Medium(epsilon=2.25)
@@ -31,6 +35,58 @@ class objview(object):
         new_obj = objview(**self.__dict__)
         return new_obj
 
+    def key(self):
+        # hashable snapshot of the parameters. Equal parameters give equal keys
+        return _hashable(self.__dict__)
+
+    def freeze(self):
+        return frozenview(**self.__dict__)
+
+
+def _hashable(val):
+    if isinstance(val, objview):
+        return val.key()
+    if isinstance(val, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in val.items()))
+    if isinstance(val, (list, tuple)):
+        return tuple(_hashable(v) for v in val)
+    if isinstance(val, mp.Vector3):
+        return ('Vector3', val.x, val.y, val.z)  # Vector3 defines __eq__ but not __hash__
+    if isinstance(val, np.ndarray):
+        if val.dtype == object:
+            return (val.shape, tuple(_hashable(v) for v in val.ravel()))
+        # a digest of the data, not a tuple of every element
+        return (val.shape, val.dtype.str, hashlib.sha1(np.ascontiguousarray(val).data).hexdigest())
+    if isinstance(val, np.generic):
+        return val.item()
+    return val
+
+
+class frozenview(objview):
+    ''' Immutable, hashable objview, for keying caches and finding identical sweep points.
+        ``copy()`` gives back an ordinary, mutable objview
+    '''
+    def __setattr__(self, name, value):
+        raise AttributeError('frozenview is immutable. Use copy() to get an objview')
+
+    def __delattr__(self, name):
+        raise AttributeError('frozenview is immutable. Use copy() to get an objview')
+
+    def update(self, *dicts, **kwargs):
+        raise AttributeError('frozenview is immutable. Use copy() to get an objview')
+
+    def freeze(self):
+        return self
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __eq__(self, other):
+        return isinstance(other, objview) and self.key() == other.key()
+
+    def __repr__(self):
+        return 'frozenview({})'.format(', '.join('{}={!r}'.format(k, v) for k, v in sorted(self.__dict__.items())))
+
 
 def show_geometry(sim_or_solver, **mpb_kwargs):
     if isinstance(sim_or_solver, mpb.ModeSolver):
@@ -42,11 +98,24 @@ def show_geometry(sim_or_solver, **mpb_kwargs):
         return show_geometry_1d(sim_or_solver)
 
 
-def show_geometry_1d(sim):
-    # raise NotImplementedError('1D Not supported yet')
-    with capture_output():
-        sim.run(until=0.1)
-    eps_data = sim.get_array(center=mp.Vector3(), size=sim.cell_size, component=mp.Dielectric)
+def _epsilon_of(sim_or_solver, resolution=None, subpixel=1):
+    # rasterized from the geometry list, so nothing is initialized. Geometry the preview
+    # does not support (such as prisms off the z axis) goes through meep or MPB as before
+    try:
+        return preview_epsilon(sim_or_solver, resolution, subpixel)
+    except NotImplementedError:
+        pass
+    if isinstance(sim_or_solver, mp.Simulation):
+        from IPython.utils.capture import capture_output
+        sim = sim_or_solver
+        with capture_output():
+            sim.run(until=0.1)
+        return sim.get_array(center=mp.Vector3(), size=sim.cell_size, component=mp.Dielectric)
+    return np.squeeze(sim_or_solver.get_epsilon())
+
+
+def show_geometry_1d(sim, resolution=None, subpixel=1):
+    eps_data = _epsilon_of(sim, resolution, subpixel)
     plt.figure(dpi=100)
     plt.plot(eps_data)
     return eps_data
@@ -57,48 +126,202 @@ def show_geometry_2d(sim_or_solver, **mpb_kwargs):
         print('Deprecation: use sim.plot2D for mp.Simulation objects')
         sim = sim_or_solver
         sim.plot2D()
-        # if not sim._is_initialized:
-        #     sim.init_sim()
-        # # sim.run(until=.0)
-        # eps_data = sim.get_array(center=mp.Vector3(), size=sim.cell_size, component=mp.Dielectric)
-        # if len(eps_data.shape) == 3:
-        #     eps_data = eps_data[:, :, int(eps_data.shape[2] / 2)]
-        #     # eps_data = eps_data[:, int(eps_data.shape[1] / 2), :]  # for x-z plane
     elif isinstance(sim_or_solver, mpb.ModeSolver):
+        # the geometry is rasterized directly, so the solver does not need to have run
         ms = sim_or_solver
-        if not any(p in mpb_kwargs.keys() for p in ['periods', 'x', 'y', 'z']):
-            mpb_kwargs['periods'] = 3
-        md = mpb.MPBData(rectify=True, resolution=ms.resolution[1], **mpb_kwargs)
-        eps = ms.get_epsilon()
-        # eps_data = md.convert(eps)  # make aspect ratios right
-        eps_data = eps
-    # plt.figure(dpi=100)
-    # plt.imshow(eps_data.transpose()[::-1], interpolation='spline36', cmap='binary')
-    # return eps_data
+        periods = mpb_kwargs.get('periods', 3)
+        eps_data = _epsilon_of(ms, mpb_kwargs.get('resolution'), mpb_kwargs.get('subpixel', 1))
+        if eps_data.ndim == 3:
+            eps_data = eps_data[:, :, eps_data.shape[2] // 2]
+        eps_data = np.tile(eps_data, (periods,) * eps_data.ndim)
+        plt.figure(dpi=100)
+        if eps_data.ndim == 1:
+            plt.plot(eps_data)
+        else:
+            plt.imshow(eps_data.transpose()[::-1], interpolation='spline36', cmap='binary')
+        return eps_data
 
 
 def show_mode(solver):
     pass
 
 
-_field_artist = None
-def liveplot(sim, component=mp.Ez, vmax=0.1):
-    ''' You must put ``mp.at_beginning(liveplot)`` in your arguments to run!
-        Make sure to turn the progress_interval up before using this
+class LiveDashboard(object):
+    ''' One figure with a panel per running simulation.
+
+        Monitors (``LiveView(dashboard=...)``) or background runs push frames with ``update``.
+        The figure is redrawn at most once per ``min_interval`` seconds no matter how many panels there are,
+        so several simulations do not flood the notebook frontend.
     '''
-    global _field_artist
-    field_data = sim.get_array(center=mp.Vector3(), size=sim.cell_size, component=component)
-    if sim.meep_time() == 0.:
-        ax = sim.plot2D()
-        extent = ax.get_images()[0].get_extent()
-        _field_artist = plt.imshow(field_data.transpose()[::-1], interpolation='spline36', cmap='RdBu',
-                                   alpha=0.8, vmin=-vmax, vmax=vmax, extent=extent)
-    else:
-        _field_artist.set_data(field_data.transpose())
+    def __init__(self, ncols=2, min_interval=1., panel_size=(5, 3)):
+        self.ncols = ncols
+        self.min_interval = min_interval
+        self.panel_size = panel_size
+        self.fig = plt.figure()
+        self.panels = dict()
+        self._next_draw = 0.
+        self.draw_time = 0.
+
+    def _layout(self):
+        nrows = int(np.ceil(len(self.panels) / self.ncols))
+        ncols = min(len(self.panels), self.ncols)
+        self.fig.set_size_inches(self.panel_size[0] * ncols, self.panel_size[1] * nrows)
+        grid = self.fig.add_gridspec(nrows, ncols)
+        for iPanel, panel in enumerate(self.panels.values()):
+            spec = grid[iPanel // ncols, iPanel % ncols]
+            panel['ax'].set_subplotspec(spec)
+            panel['ax'].set_position(spec.get_position(self.fig))
+
+    def panel(self, name, frame, extent=None, vmax=0.1, background=None):
+        ''' Creates the panel the first time a name is seen '''
+        if name not in self.panels:
+            ax = self.fig.add_subplot(1, 1, 1)
+            if background is not None:
+                ax.imshow(background, cmap='binary', extent=extent, origin='lower')
+            artist = ax.imshow(frame, interpolation='bilinear', cmap='RdBu', alpha=0.8,
+                               vmin=-vmax, vmax=vmax, extent=extent, origin='lower')
+            self.panels[name] = dict(ax=ax, artist=artist)
+            self._layout()
+        return self.panels[name]
+
+    def update(self, name, frame, title=None, **panel_kwargs):
+        panel = self.panel(name, frame, **panel_kwargs)
+        panel['artist'].set_data(frame)
+        panel['ax'].set_title('{}: {}'.format(name, title) if title is not None else str(name))
+        self.request_draw()
+
+    def request_draw(self, force=False):
+        now = time.time()
+        if now < self._next_draw and not force:
+            return
+        if 'inline' in matplotlib.get_backend():
+            display.clear_output(wait=True)
+            display.display(self.fig)
+        else:
+            self.fig.canvas.draw_idle()
+            self.fig.canvas.flush_events()
+        self.draw_time += time.time() - now
+        self._next_draw = now + self.min_interval
+
+
+def strided_array(sim, component, stride=1, arr=None):
+    ''' Field over the cell on every ``stride``-th grid point, shaped like ``sim.get_array``.
+        Only every stride-th row is read, so a larger stride also makes the read cheaper. Fills arr if given
+    '''
+    if stride == 1:
+        return sim.get_array(center=mp.Vector3(), size=sim.cell_size, component=component, arr=arr)
+    ny = max(1, int(round(sim.cell_size.y * sim.resolution)))
+    ys = -sim.cell_size.y / 2 + (np.arange(0, ny, stride) + 0.5) / sim.resolution
+    row_size = mp.Vector3(sim.cell_size.x, 0, 0)
+    for iRow, y in enumerate(ys):
+        row = sim.get_array(center=mp.Vector3(0, y), size=row_size, component=component)[::stride]
+        if arr is None:
+            arr = np.empty((len(row), len(ys)), dtype=row.dtype)
+        arr[:, iRow] = row
+    return arr
+
+
+class LiveView(object):
+    ''' Low-overhead live field view of one simulation. Pass its ``step`` to run::
 
-    plt.title(f't = {sim.meep_time()}')
-    display.clear_output(wait=True)
-    display.display(plt.gcf())
+            live = LiveView(mp.Ez, vmax=0.1, stride=2)
+            sim.run(live.step, until=200)
+            print(live.overhead)
+
+        Frames are rate-limited by wall-clock time, not simulation time.
+        The next frame waits at least ``min_interval`` seconds, and long enough that drawing
+        stays below ``max_overhead`` (a fraction) of the run time. Skipped calls only read the clock.
+        Only every ``stride``-th point of the field is read, into a preallocated buffer.
+        With an interactive backend (``%matplotlib widget``), only the field image is redrawn (blitting).
+        With the inline backend, a PNG is sent at most once per frame.
+
+        All state lives in the object, so there can be one per simulation.
+        Give several of them the same ``LiveDashboard`` to watch them in one figure.
+    '''
+    def __init__(self, component=mp.Ez, vmax=0.1, stride=1, min_interval=0.5, max_overhead=0.05,
+                 dashboard=None, name=None):
+        self.component = component
+        self.vmax = vmax
+        self.stride = stride
+        self.min_interval = min_interval if dashboard is None else dashboard.min_interval
+        self.max_overhead = max_overhead
+        self.dashboard = dashboard
+        self.name = name if name is not None else 'sim {}'.format(id(self))
+        self.sim = None
+
+    def _setup(self, sim):
+        self.sim = sim
+        self._buffer = strided_array(sim, self.component, self.stride)
+        if self.dashboard is None:
+            ax = sim.plot2D()
+            self.fig = ax.figure
+            extent = ax.get_images()[0].get_extent()
+            self._blit = 'inline' not in matplotlib.get_backend() and self.fig.canvas.supports_blit
+            self._artist = ax.imshow(self._frame(), interpolation='bilinear', cmap='RdBu', alpha=0.8,
+                                     vmin=-self.vmax, vmax=self.vmax, extent=extent, origin='lower',
+                                     animated=self._blit)
+            self._text = ax.text(0.02, 0.95, '', transform=ax.transAxes, animated=self._blit)
+            self.ax = ax
+            if self._blit:
+                self.fig.canvas.draw()
+                self._background = self.fig.canvas.copy_from_bbox(ax.bbox)
+        else:
+            eps = strided_array(sim, mp.Dielectric, self.stride)
+            half = sim.cell_size / 2
+            self.dashboard.panel(self.name, self._frame(), vmax=self.vmax,
+                                 extent=[-half.x, half.x, -half.y, half.y],
+                                 background=eps.transpose())
+        self._t_start = time.time()
+        self._next_draw = self._t_start
+        self._last_meep_time = sim.meep_time()
+        self.draw_time = 0.
+        self.n_frames = 0
+
+    def _frame(self):
+        return self._buffer.transpose()
+
+    def __call__(self, sim):
+        now = time.time()
+        if sim is not self.sim or sim.meep_time() < self._last_meep_time:
+            self._setup(sim)  # new simulation or restarted run
+        self._last_meep_time = sim.meep_time()
+        if now < self._next_draw:
+            return
+        strided_array(sim, self.component, self.stride, arr=self._buffer)
+        title = f't = {sim.meep_time():.1f}'
+        if self.dashboard is not None:
+            self.dashboard.update(self.name, self._frame(), title=title)
+        elif self._blit:
+            self._artist.set_data(self._frame())
+            self._text.set_text(title)
+            self.fig.canvas.restore_region(self._background)
+            self.ax.draw_artist(self._artist)
+            self.ax.draw_artist(self._text)
+            self.fig.canvas.blit(self.ax.bbox)
+            self.fig.canvas.flush_events()
+        else:
+            self._artist.set_data(self._frame())
+            self._text.set_text(title)
+            display.clear_output(wait=True)
+            display.display(self.fig)
+        t_draw = time.time() - now
+        self.draw_time += t_draw
+        self.n_frames += 1
+        self._next_draw = now + max(self.min_interval, t_draw / self.max_overhead)
+
+    @property
+    def step(self):
+        ''' This view as a plain function. meep calls step functions by their argument count, which an instance lacks '''
+        def step(sim):
+            self(sim)
+        return step
+
+    @property
+    def overhead(self):
+        ''' Fraction of wall time spent in live view since the run started '''
+        if self.sim is None:
+            return 0.
+        return self.draw_time / max(time.time() - self._t_start, 1e-9)
 
 
 def x_field_data(sim, component=mp.Ey):
@@ -107,29 +330,106 @@ def x_field_data(sim, component=mp.Ey):
     return xspan, e_data
 
 
-_eline = None
-def liveplot_1D(sim, component=mp.Ey):
-    global _eline
-    if sim.meep_time() == 0.:
-        xspan, eps_data = x_field_data(sim, component=mp.Dielectric)
-        # if eps_data.ndim > 1:
-        #     eps_data = eps_data[:, :, int(eps_data.shape[2] / 2)]
-        # todo dielectric artist
-
-        comp_name = 'Ey' if component == mp.Ey else 'Ez' if component == mp.Ez else 'Ex'
-        _eline, = plt.gca().plot(xspan, np.zeros_like(xspan), 'r', label=comp_name)
-    else:
-        # now do the field
-        xspan, e_data = x_field_data(sim, component=component)
-        _eline.set_data(xspan, e_data)
+class LiveLine(object):
+    ''' Live 1D field plot of one simulation. Use it as a step function '''
+    def __init__(self, component=mp.Ey):
+        self.component = component
+        self.sim = None
+
+    def __call__(self, sim):
+        if sim is not self.sim or sim.meep_time() < self._last_meep_time:
+            self.sim = sim
+            self._last_meep_time = sim.meep_time()
+            xspan, eps_data = x_field_data(sim, component=mp.Dielectric)
+            # todo dielectric artist
+            comp_name = 'Ey' if self.component == mp.Ey else 'Ez' if self.component == mp.Ez else 'Ex'
+            self._eline, = plt.gca().plot(xspan, np.zeros_like(xspan), 'r', label=comp_name)
+            return
+        self._last_meep_time = sim.meep_time()
+        xspan, e_data = x_field_data(sim, component=self.component)
+        self._eline.set_data(xspan, e_data)
         plt.title(f't = {sim.meep_time()}')
         plt.legend()
         display.clear_output(wait=True)
         display.display(plt.gcf())
 
 
+# The function versions keep one monitor per simulation, so they work on several at once
+_live_monitors = weakref.WeakKeyDictionary()
+
+
+def _monitor_for(sim, key, make_monitor):
+    monitors = _live_monitors.setdefault(sim, dict())
+    if key not in monitors:
+        monitors[key] = make_monitor()
+    return monitors[key]
+
+
+def liveplot(sim, component=mp.Ez, vmax=0.1):
+    ''' You must put ``mp.at_beginning(liveplot)`` in your arguments to run!
+        Make sure to turn the progress_interval up before using this
+    '''
+    monitor = _monitor_for(sim, ('2d', component, vmax),
+                           lambda: LiveView(component, vmax=vmax, min_interval=0, max_overhead=1))
+    monitor(sim)
+
+
+def liveplot_1D(sim, component=mp.Ey):
+    monitor = _monitor_for(sim, ('1d', component), lambda: LiveLine(component))
+    monitor(sim)
+
+
+class FieldMovie(object):
+    ''' Streams field frames straight into an animated gif or mp4. Pass its ``step`` to run::
+
+            with FieldMovie('ez.gif', mp.Ez, vmax=0.1, stride=2) as movie:
+                sim.run(mp.at_every(0.6, movie.step), until=200)
+
+        This replaces the ``output_png`` + ``to_gif`` round trip. There are no intermediate files
+        and no external programs, and memory stays at one frame.
+        If vmax is None, each frame is scaled to the largest field seen so far. Frames before the pulse
+        reaches its peak are then brighter than the rest, so give vmax when the colors must be comparable.
+    '''
+    def __init__(self, filename, component=mp.Ez, vmax=None, stride=1, fps=20, cmap='RdBu'):
+        self.filename = filename
+        self.component = component
+        self.vmax = vmax
+        self.stride = stride
+        self.writer = open_movie(filename, colormap_palette(cmap), fps=fps)
+        self._buffer = None
+        self._peak = 0.
+
+    def __call__(self, sim):
+        self._buffer = strided_array(sim, self.component, self.stride, arr=self._buffer)
+        frame = self._buffer.transpose()[::-1]
+        vmax = self.vmax
+        if vmax is None:
+            self._peak = max(self._peak, np.max(np.abs(frame)))
+            if self._peak == 0:
+                return
+            vmax = self._peak
+        self.writer.append(to_indices(frame, vmax))
+
+    @property
+    def step(self):
+        ''' This movie as a plain function, for sim.run or mp.at_every '''
+        def step(sim):
+            self(sim)
+        return step
+
+    def close(self):
+        self.writer.close()
+        return self.filename
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 def to_gif(output_dir, field_type='ez'):
-    # Converts pngs from your simulation into a nice gif
+    # Converts pngs from your simulation into a nice gif. FieldMovie does this without the pngs
     # You must have imagemagik in order to use convert
     gif_name = field_type + '.gif'
     simdata_glob = os.path.join(output_dir, field_type + '-*.png')
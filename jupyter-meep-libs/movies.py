@@ -0,0 +1,141 @@
+''' Streaming animated gif/mp4 writers for field movies.
+
+    Frames are written as they come, so memory stays at one frame and there are no intermediate pngs.
+    Gifs need nothing but numpy. Mp4s need ``imageio`` with ``imageio-ffmpeg`` (pip installable).
+'''
+import numpy as np
+
+
+def colormap_palette(cmap='RdBu'):
+    # (256, 3) uint8 lookup table from a matplotlib colormap
+    import matplotlib.pyplot as plt
+    colors = plt.get_cmap(cmap)(np.linspace(0, 1, 256))[:, :3]
+    return np.round(colors * 255).astype(np.uint8)
+
+
+def to_indices(data, vmax):
+    # symmetric field to palette indices. -vmax -> 0, 0 -> 127.5, +vmax -> 255
+    scaled = (np.asarray(data, dtype=float) / vmax + 1) * 127.5
+    return np.clip(np.round(scaled), 0, 255).astype(np.uint8)
+
+
+def _lzw_encode(indices, min_code_size=8):
+    # Variable-length-code LZW, as in the gif spec. Returns packed bytes
+    clear_code = 1 << min_code_size
+    end_code = clear_code + 1
+    out = bytearray()
+    bit_buffer = 0
+    n_bits = 0
+    code_size = min_code_size + 1
+    next_code = end_code + 1
+    table = dict()
+
+    def emit(code, size):
+        nonlocal bit_buffer, n_bits
+        bit_buffer |= code << n_bits
+        n_bits += size
+        while n_bits >= 8:
+            out.append(bit_buffer & 0xFF)
+            bit_buffer >>= 8
+            n_bits -= 8
+
+    emit(clear_code, code_size)
+    data = indices.tobytes()
+    prefix = data[0]
+    for byte in data[1:]:
+        key = (prefix << 8) | byte
+        code = table.get(key)
+        if code is not None:
+            prefix = code
+            continue
+        emit(prefix, code_size)
+        if next_code < 4096:
+            if next_code > (1 << code_size) - 1:
+                code_size += 1
+            table[key] = next_code
+            next_code += 1
+        else:
+            emit(clear_code, code_size)
+            table.clear()
+            next_code = end_code + 1
+            code_size = min_code_size + 1
+        prefix = byte
+    emit(prefix, code_size)
+    if next_code > (1 << code_size) - 1 and code_size < 12:
+        code_size += 1
+    emit(end_code, code_size)
+    if n_bits > 0:
+        out.append(bit_buffer & 0xFF)
+    return bytes(out)
+
+
+class GifWriter(object):
+    ''' Appends palette-index frames to an animated gif on disk. One global palette for all frames '''
+    def __init__(self, filename, palette, fps=20, loop=True):
+        self.filename = filename
+        self.palette = np.asarray(palette, dtype=np.uint8)
+        self.delay = int(round(100 / fps))  # centiseconds
+        self.loop = loop
+        self._fx = None
+        self.n_frames = 0
+
+    def _write_header(self, height, width):
+        self._fx = open(self.filename, 'wb')
+        self.shape = (height, width)
+        self._fx.write(b'GIF89a')
+        self._fx.write(np.array([width, height], dtype='<u2').tobytes())
+        self._fx.write(bytes([0xF7, 0, 0]))  # 256-color global table
+        self._fx.write(self.palette.tobytes())
+        if self.loop:
+            self._fx.write(b'\x21\xFF\x0BNETSCAPE2.0\x03\x01\x00\x00\x00')
+
+    def append(self, indices):
+        ''' indices is a (height, width) uint8 array, such as from ``to_indices`` '''
+        indices = np.ascontiguousarray(indices, dtype=np.uint8)
+        if self._fx is None:
+            self._write_header(*indices.shape)
+        elif indices.shape != self.shape:
+            raise ValueError('Frame shape {} does not match {}'.format(indices.shape, self.shape))
+        height, width = indices.shape
+        self._fx.write(b'\x21\xF9\x04\x04' + np.array([self.delay], dtype='<u2').tobytes() + b'\x00\x00')
+        self._fx.write(b'\x2C' + np.array([0, 0, width, height], dtype='<u2').tobytes() + b'\x00')
+        self._fx.write(b'\x08')
+        data = _lzw_encode(indices.ravel())
+        for i0 in range(0, len(data), 255):
+            block = data[i0:i0 + 255]
+            self._fx.write(bytes([len(block)]) + block)
+        self._fx.write(b'\x00')
+        self.n_frames += 1
+
+    def close(self):
+        if self._fx is not None:
+            self._fx.write(b'\x3B')
+            self._fx.close()
+            self._fx = None
+
+
+class Mp4Writer(object):
+    ''' Appends palette-index frames to an mp4 through an imageio/ffmpeg pipe '''
+    def __init__(self, filename, palette, fps=20):
+        try:
+            import imageio
+        except ImportError:
+            raise ImportError('mp4 output needs imageio and imageio-ffmpeg. Use a .gif filename otherwise')
+        self.filename = filename
+        self.palette = np.asarray(palette, dtype=np.uint8)
+        self._writer = imageio.get_writer(filename, fps=fps, macro_block_size=1)
+        self.n_frames = 0
+
+    def append(self, indices):
+        self._writer.append_data(self.palette[indices])
+        self.n_frames += 1
+
+    def close(self):
+        self._writer.close()
+
+
+def open_movie(filename, palette, fps=20):
+    # picks the writer by extension
+    if filename.lower().endswith('.gif'):
+        return GifWriter(filename, palette, fps=fps)
+    return Mp4Writer(filename, palette, fps=fps)
@@ -0,0 +1,232 @@
+''' Fast epsilon maps straight from geometry lists, without init_sim or a ModeSolver run.
+
+    Blocks, prisms, cylinders, spheres and ellipsoids are rasterized with numpy, each one only
+    within its bounding box, and later objects take precedence like in MEEP.
+    Works on the lists from ``device_to_meep``, ``bragg_geometry`` and ``partial_wgs.get_xs``::
+
+        eps = preview_epsilon(sim, resolution=10)  # or a ModeSolver, or epsilon_map(geometry, cell_size)
+        show_epsilon(sim, z=0.11)                  # 3D cells are shown as a slice
+
+    ``subpixel`` rasterizes that many times finer in each direction and averages epsilon back down.
+    This is the arithmetic mean, not MEEP's anisotropic averaging, but it shows sub-pixel features and steps.
+'''
+import numpy as np
+import meep as mp
+
+
+def _epsilon(material):
+    # scalar epsilon of a medium or a number. None for the conversions sentinels and anything unknown
+    if isinstance(material, (int, float)):
+        return float(material)
+    diag = getattr(material, 'epsilon_diag', None)
+    if diag is None:
+        return None
+    return float(np.mean([diag.x, diag.y, diag.z]))
+
+
+def _axis_coords(center, size, resolution, subpixel):
+    # pixel centers along one axis. A zero size is a single plane at center
+    if size == 0:
+        return np.array([center])
+    n_fine = max(1, int(round(size * resolution))) * subpixel
+    return center - size / 2 + (np.arange(n_fine) + 0.5) * size / n_fine
+
+
+def _bbox_slices(coords, lo, hi):
+    return tuple(slice(np.searchsorted(c, l, 'left'), np.searchsorted(c, h, 'right')) if len(c) > 1 else slice(None)
+                 for c, l, h in zip(coords, lo, hi))
+
+
+def _sub_mesh(coords, slices, center):
+    # coordinates relative to center on the sub-grid. Planar axes are 0, so objects extend through them
+    axes = [c[sl] - c0 if len(c) > 1 else np.zeros(1) for c, sl, c0 in zip(coords, slices, center)]
+    return np.meshgrid(*axes, indexing='ij')
+
+
+def _vec(vector):
+    return np.array([vector.x, vector.y, vector.z], dtype=float)
+
+
+def _finite(vals, big=1e20):
+    return np.clip(np.nan_to_num(np.asarray(vals, dtype=float), posinf=big, neginf=-big), -big, big)
+
+
+def points_in_polygon(x, y, poly):
+    # even-odd rule, vectorized over the points and looping over edges
+    inside = np.zeros(np.shape(x), dtype=bool)
+    for (x0, y0), (x1, y1) in zip(poly, np.roll(poly, -1, axis=0)):
+        crosses = (y0 > y) != (y1 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        inside ^= crosses & (x < x_cross)
+    return inside
+
+
+def distance_to_polygon(x, y, poly):
+    # distance from each point to the nearest edge
+    dist = np.full(np.shape(x), np.inf)
+    for (x0, y0), (x1, y1) in zip(poly, np.roll(poly, -1, axis=0)):
+        dx, dy = x1 - x0, y1 - y0
+        t = np.clip(((x - x0) * dx + (y - y0) * dy) / max(dx * dx + dy * dy, 1e-30), 0, 1)
+        dist = np.minimum(dist, np.hypot(x - x0 - t * dx, y - y0 - t * dy))
+    return dist
+
+
+def _paint_block(eps, coords, block):
+    center = _vec(block.center)
+    size = _finite(_vec(block.size))
+    basis = np.array([_vec(block.e1), _vec(block.e2), _vec(block.e3)])
+    basis /= np.linalg.norm(basis, axis=1)[:, None]
+    axis_aligned = np.allclose(basis, np.eye(3))
+    half_extent = np.abs(basis.T) @ (size / 2)
+    slices = _bbox_slices(coords, center - half_extent, center + half_extent)
+    material = block.material
+    is_grid = hasattr(material, 'weights') and hasattr(material, 'medium1')
+    is_ellipsoid = isinstance(block, mp.Ellipsoid)
+    if axis_aligned and not is_grid and not is_ellipsoid:
+        value = _epsilon(material)
+        if value is not None:
+            eps[slices] = value
+        return
+    mesh = _sub_mesh(coords, slices, center)
+    # coordinates in the block basis, in units of its half size
+    local = np.tensordot(np.linalg.inv(basis.T), np.array(mesh), axes=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scaled = local / (size / 2)[:, None, None, None]
+    scaled = np.where((size / 2)[:, None, None, None] > 0, scaled, 0)
+    if is_ellipsoid:
+        mask = np.sum(scaled ** 2, axis=0) <= 1
+    else:
+        mask = np.all(np.abs(scaled) <= 1, axis=0)
+    if is_grid:
+        eps1, eps2 = _epsilon(material.medium1), _epsilon(material.medium2)
+        grid_size = [max(1, int(n)) for n in (material.grid_size.x, material.grid_size.y, material.grid_size.z)]
+        weights = np.reshape(material.weights, grid_size)
+        idx = [np.clip(((s + 1) / 2 * n).astype(int), 0, n - 1) for s, n in zip(scaled, grid_size)]
+        values = eps1 + weights[tuple(idx)] * (eps2 - eps1)
+        eps[slices] = np.where(mask, values, eps[slices])
+    else:
+        value = _epsilon(material)
+        if value is not None:
+            eps[slices] = np.where(mask, value, eps[slices])
+
+
+def _paint_prism(eps, coords, prism):
+    axis = _vec(prism.axis) / np.linalg.norm(_vec(prism.axis))
+    if not np.allclose(np.abs(axis), [0, 0, 1]):
+        raise NotImplementedError('Preview only supports prisms along z')
+    value = _epsilon(prism.material)
+    if value is None:
+        return
+    verts = np.array([[v.x, v.y] for v in prism.vertices])
+    z_base = prism.vertices[0].z
+    z_lo, z_hi = sorted([z_base, z_base + axis[2] * prism.height])
+    slices = _bbox_slices(coords, [verts[:, 0].min(), verts[:, 1].min(), z_lo], [verts[:, 0].max(), verts[:, 1].max(), z_hi])
+    x, y = np.meshgrid(coords[0][slices[0]], coords[1][slices[1]], indexing='ij')
+    mask = points_in_polygon(x, y, verts)
+    sidewall_angle = getattr(prism, 'sidewall_angle', 0)
+    sub = eps[slices]
+    if len(coords[2]) == 1 or not sidewall_angle:
+        sub[...] = np.where(mask[:, :, None], value, sub)
+        return
+    # sidewalls: the outline moves in by (z - z_base) * tan(angle)
+    dist = distance_to_polygon(x, y, verts)
+    for k, z in enumerate(coords[2][slices[2]]):
+        inset = abs(z - z_base) * np.tan(sidewall_angle)
+        layer_mask = mask & (dist >= inset) if inset >= 0 else mask | (dist <= -inset)
+        sub[:, :, k][layer_mask] = value
+
+
+def _paint_round(eps, coords, obj):
+    # cylinders and spheres
+    value = _epsilon(obj.material)
+    if value is None:
+        return
+    center = _vec(obj.center)
+    radius = float(obj.radius)
+    height = float(_finite(getattr(obj, 'height', 0)))
+    reach = max(radius, height / 2)
+    slices = _bbox_slices(coords, center - reach, center + reach)
+    rel = np.array(_sub_mesh(coords, slices, center))
+    if isinstance(obj, mp.Sphere):
+        mask = np.sum(rel ** 2, axis=0) <= radius ** 2
+    else:
+        axis = _vec(obj.axis) / np.linalg.norm(_vec(obj.axis))
+        along = np.tensordot(axis, rel, axes=1)
+        radial = rel - axis[:, None, None, None] * along
+        mask = (np.sum(radial ** 2, axis=0) <= radius ** 2) & (np.abs(along) <= height / 2 + 1e-12)
+    eps[slices] = np.where(mask, value, eps[slices])
+
+
+def epsilon_map(geometry, cell_size, resolution=10, center=None, default_material=1., subpixel=1):
+    ''' Epsilon on a grid of pixel centers, shaped like ``sim.get_array`` (zero-size axes are dropped).
+        Returns the map and the coordinates along x, y, z (a single value on zero-size axes)
+    '''
+    center = mp.Vector3() if center is None else center
+    coords = [_axis_coords(c, s, resolution, subpixel)
+              for c, s in zip(_vec(center), _vec(cell_size))]
+    default = _epsilon(default_material)
+    eps = np.full([len(c) for c in coords], 1. if default is None else default)
+    for obj in geometry:
+        if isinstance(obj, mp.Block):
+            _paint_block(eps, coords, obj)
+        elif isinstance(obj, mp.Prism):
+            _paint_prism(eps, coords, obj)
+        elif isinstance(obj, (mp.Cylinder, mp.Sphere)):
+            _paint_round(eps, coords, obj)
+        else:
+            raise NotImplementedError('Preview does not support {}'.format(type(obj).__name__))
+    if subpixel > 1:
+        for iAxis, c in enumerate(coords):
+            if len(c) > 1:
+                shape = eps.shape[:iAxis] + (len(c) // subpixel, subpixel) + eps.shape[iAxis + 1:]
+                eps = eps.reshape(shape).mean(axis=iAxis + 1)
+                coords[iAxis] = c.reshape(-1, subpixel).mean(axis=1)
+    planar = tuple(iAxis for iAxis, c in enumerate(coords) if len(c) == 1)
+    return np.squeeze(eps, axis=planar), coords
+
+
+def _preview(sim_or_solver, resolution=None, subpixel=1):
+    if hasattr(sim_or_solver, 'geometry_lattice'):
+        ms = sim_or_solver
+        basis = np.array([_vec(getattr(ms.geometry_lattice, name, v))
+                          for name, v in [('basis1', mp.Vector3(1)), ('basis2', mp.Vector3(0, 1)), ('basis3', mp.Vector3(0, 0, 1))]])
+        gram = basis @ basis.T
+        if not np.allclose(gram, np.diag(np.diag(gram))):
+            raise NotImplementedError('Preview only supports rectangular lattices')
+        cell_size, center = ms.geometry_lattice.size, mp.Vector3()
+        own_resolution = ms.resolution
+    else:
+        sim = sim_or_solver
+        cell_size, center = sim.cell_size, getattr(sim, 'geometry_center', mp.Vector3())
+        own_resolution = sim.resolution
+    if resolution is None:
+        resolution = own_resolution if np.isscalar(own_resolution) else max(_vec(own_resolution))
+    return epsilon_map(sim_or_solver.geometry, cell_size, resolution, center,
+                       sim_or_solver.default_material, subpixel)
+
+
+def preview_epsilon(sim_or_solver, resolution=None, subpixel=1):
+    ''' epsilon_map of an ``mp.Simulation`` or ``mpb.ModeSolver``, without initializing it.
+        Resolution defaults to the simulation's own
+    '''
+    return _preview(sim_or_solver, resolution, subpixel)[0]
+
+
+def show_epsilon(sim_or_solver, resolution=None, subpixel=1, z=None, ax=None):
+    ''' Plots the preview. 3D cells are shown as the x-y slice nearest z (default: the cell center). Returns the map '''
+    import matplotlib.pyplot as plt
+    if ax is None:
+        ax = plt.figure(dpi=100).gca()
+    eps, coords = _preview(sim_or_solver, resolution, subpixel)
+    spans = [c for c in coords if len(c) > 1]
+    if eps.ndim == 1:
+        ax.plot(spans[0], eps)
+        ax.set_ylabel('epsilon')
+        return eps
+    if eps.ndim == 3:
+        z = np.mean(coords[2]) if z is None else z
+        eps = eps[:, :, int(np.argmin(np.abs(coords[2] - z)))]
+    ax.imshow(eps.transpose(), origin='lower', cmap='binary', interpolation='none',
+              extent=[spans[0][0], spans[0][-1], spans[1][0], spans[1][-1]])
+    return eps
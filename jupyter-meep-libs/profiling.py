@@ -0,0 +1,168 @@
+''' Where the time goes in a simulation: per-phase wall time and memory, and time-stepping throughput.
+
+    Phases are geometry conversion, ``init_sim`` (structure and subpixel averaging), eigenmode source solves,
+    other sources, time stepping, DFT monitor updates, step-function callbacks (such as liveplot) and output.
+    Usage::
+
+        prof = RunProfile()
+        with prof.phase('geometry'):
+            geometry = bragg_geometry(geo)
+        sim = mp.Simulation(geometry=geometry, ...)
+        refl = sim.add_flux(...)
+        prof.init(sim)  # instead of sim.init_sim()
+        prof.run(sim, mp.at_every(5, livefield), until=200)  # instead of sim.run
+        prof.show()
+
+    ``prof.as_dict()`` has the same numbers for saving with sweep results.
+'''
+import os
+import time
+import inspect
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+import meep as mp
+
+
+def _rss():
+    # resident memory of this process in bytes
+    try:
+        with open('/proc/self/statm') as fx:
+            return int(fx.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        scale = 1 if os.uname().sysname == 'Darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale  # peak, the best available
+
+
+def _time_sink(sim, name):
+    # seconds meep itself attributes to one of its time sinks, or None on versions without them
+    sink = getattr(mp, name, None)
+    if sink is None or not hasattr(sim, 'time_spent_on'):
+        return None
+    try:
+        return float(np.max(sim.time_spent_on(sink)))
+    except Exception:
+        return None
+
+
+def n_voxels(sim):
+    # grid points that are actually stepped. Each mirror or 2-fold rotation halves the cell, a 4-fold rotation quarters it
+    dims = [sim.cell_size.x, sim.cell_size.y, sim.cell_size.z]
+    full = np.prod([max(1, int(round(dim * sim.resolution))) for dim in dims])
+    reduction = 1
+    for symmetry in sim.symmetries or []:
+        reduction *= 4 if isinstance(symmetry, mp.Rotate4) else 2
+    return int(full // reduction)
+
+
+class RunProfile(object):
+    ''' Wall time and memory change of each phase of one simulation, and its throughput '''
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.callbacks = OrderedDict()
+        self.steps = 0
+        self.voxels = 0
+
+    def _add(self, name, seconds, memory=0):
+        entry = self.phases.setdefault(name, dict(seconds=0., memory=0))
+        entry['seconds'] += seconds
+        entry['memory'] += memory
+
+    @contextmanager
+    def phase(self, name):
+        ''' Times anything, such as geometry conversion or saving results '''
+        rss0, t0 = _rss(), time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add(name, time.perf_counter() - t0, _rss() - rss0)
+
+    def init(self, sim):
+        ''' Replaces ``sim.init_sim()``. Eigenmode source solves are timed apart from the structure '''
+        if sim.fields is not None:
+            return  # already initialized, nothing to split
+        sources = list(sim.sources)
+        sim.sources = []
+        with self.phase('init_sim'):
+            sim.init_sim()
+        sim.sources = []
+        for src in sources:
+            with self.phase('eigenmode_source' if isinstance(src, mp.EigenModeSource) else 'sources'):
+                sim.add_source(src)
+        sim.sources = sources
+        self.voxels = n_voxels(sim)
+
+    def _timed(self, func, name):
+        # meep calls step functions with (sim, todo) or, only when todo is 'step', with (sim)
+        takes_todo = len(inspect.signature(func).parameters) == 2
+        self.callbacks.setdefault(name, 0.)
+        def timed_step(sim, todo):
+            if not takes_todo and todo != 'step':
+                return
+            t0 = time.perf_counter()
+            if takes_todo:
+                func(sim, todo)
+            else:
+                func(sim)
+            self.callbacks[name] += time.perf_counter() - t0
+        return timed_step
+
+    def run(self, sim, *step_funcs, **run_kwargs):
+        ''' Replaces ``sim.run(*step_funcs, **run_kwargs)``, timing every step function separately '''
+        self.init(sim)
+        timed = [self._timed(func, '{}:{}'.format(iFunc, getattr(func, '__name__', 'step')))
+                 for iFunc, func in enumerate(step_funcs)]
+        dft0, output0 = _time_sink(sim, 'FourierTransforming'), _time_sink(sim, 'FieldOutput')
+        step0 = sim.timestep()
+        callbacks0 = sum(self.callbacks.values())
+        rss0, t0 = _rss(), time.perf_counter()
+        sim.run(*timed, **run_kwargs)
+        wall, memory = time.perf_counter() - t0, _rss() - rss0
+        self.steps += sim.timestep() - step0
+        callback_time = sum(self.callbacks.values()) - callbacks0
+        dft1, output1 = _time_sink(sim, 'FourierTransforming'), _time_sink(sim, 'FieldOutput')
+        dft_time = dft1 - dft0 if dft0 is not None and dft1 is not None else 0.
+        output_time = output1 - output0 if output0 is not None and output1 is not None else 0.
+        self._add('stepping', max(wall - callback_time - dft_time - output_time, 0.), memory)
+        self._add('dft_monitors', dft_time)
+        self._add('callbacks', callback_time)
+        self._add('output', output_time)
+        return sim
+
+    @property
+    def stepping_seconds(self):
+        return self.phases.get('stepping', dict(seconds=0.))['seconds']
+
+    @property
+    def total_seconds(self):
+        return sum(entry['seconds'] for entry in self.phases.values())
+
+    @property
+    def steps_per_second(self):
+        return self.steps / self.stepping_seconds if self.stepping_seconds > 0 else float('nan')
+
+    @property
+    def voxel_updates_per_second(self):
+        return self.voxels * self.steps_per_second
+
+    def as_dict(self):
+        return dict(phases={name: dict(entry) for name, entry in self.phases.items()},
+                    callbacks=dict(self.callbacks), steps=self.steps, voxels=self.voxels,
+                    total_seconds=self.total_seconds, steps_per_second=self.steps_per_second,
+                    voxel_updates_per_second=self.voxel_updates_per_second)
+
+    def summary(self):
+        total = max(self.total_seconds, 1e-12)
+        lines = ['{:<18} {:>10} {:>7} {:>10}'.format('phase', 'seconds', '%', 'memory')]
+        for name, entry in self.phases.items():
+            lines.append('{:<18} {:>10.3f} {:>6.1f}% {:>7.1f} MB'.format(
+                name, entry['seconds'], 100 * entry['seconds'] / total, entry['memory'] / 1e6))
+        for name, seconds in self.callbacks.items():
+            lines.append('  {:<16} {:>10.3f} {:>6.1f}%'.format(name, seconds, 100 * seconds / total))
+        lines.append('{} steps, {:.1f} steps/s, {:.3g} voxel-updates/s ({} voxels)'.format(
+            self.steps, self.steps_per_second, self.voxel_updates_per_second, self.voxels))
+        return '\n'.join(lines)
+
+    def show(self):
+        print(self.summary())
@@ -0,0 +1,173 @@
+''' Append-as-you-go sweep results, stored as chunked numpy files that can be memory-mapped.
+
+    A store is a directory::
+
+        index.json           parameters of every point, and array shapes
+        <name>_0000.npy      rows 0 .. chunk_size-1 of array <name>, one row per sweep point
+        <name>_0001.npy      ...
+
+    Each point is flushed to disk when appended, so a crashed sweep keeps what it finished.
+    Reading one point only touches the chunk it lives in. Usage::
+
+        store = ResultStore('bragg-dw')
+        for params, spectra in sweep(normalized_run, grid):
+            store.append(params, **spectra)
+
+        store = ResultStore('bragg-dw')  # later, or in another kernel
+        iPoint = store.find(dw=.3)[0]
+        plt.plot(store[iPoint]['freqs'], store[iPoint]['T'])
+
+    ``convert_pickle_gzip`` converts the old lightlab ``.pkl.gz`` files in ``data/``.
+'''
+import os
+import json
+import gzip
+import pickle
+import numpy as np
+
+
+class ResultStore(object):
+    ''' Rows of same-shaped arrays, one row per sweep point, plus json-able parameters for each point '''
+    def __init__(self, directory, chunk_size=64):
+        self.directory = directory
+        self._index_file = os.path.join(directory, 'index.json')
+        if os.path.isfile(self._index_file):
+            with open(self._index_file) as fx:
+                self._index = json.load(fx)
+        else:
+            self._index = dict(chunk_size=chunk_size, arrays=dict(), params=[])
+        self.chunk_size = self._index['chunk_size']
+        self._open_chunks = dict()
+
+    def __len__(self):
+        return len(self._index['params'])
+
+    @property
+    def params(self):
+        return self._index['params']
+
+    @property
+    def names(self):
+        return list(self._index['arrays'].keys())
+
+    def _chunk_file(self, name, iChunk):
+        return os.path.join(self.directory, '{}_{:04d}.npy'.format(name, iChunk))
+
+    def _chunk(self, name, iChunk, writing=False):
+        key = (name, iChunk, writing)
+        if key not in self._open_chunks:
+            fname = self._chunk_file(name, iChunk)
+            if writing and not os.path.isfile(fname):
+                spec = self._index['arrays'][name]
+                shape = (self.chunk_size,) + tuple(spec['shape'])
+                chunk = np.lib.format.open_memmap(fname, mode='w+', dtype=spec['dtype'], shape=shape)
+            else:
+                chunk = np.load(fname, mmap_mode='r+' if writing else 'r')
+            self._open_chunks[key] = chunk
+        return self._open_chunks[key]
+
+    def _write_index(self):
+        tmp_file = self._index_file + '.tmp'
+        with open(tmp_file, 'w') as fx:
+            json.dump(self._index, fx, default=_to_json)
+        os.replace(tmp_file, self._index_file)  # so a crash never leaves a half-written index
+
+    def append(self, params, **arrays):
+        ''' Adds one point. All points must have the same array names and shapes. Returns its index '''
+        os.makedirs(self.directory, exist_ok=True)
+        arrays = {name: np.asarray(val) for name, val in arrays.items()}
+        if len(self) == 0 and len(self._index['arrays']) == 0:
+            self._index['arrays'] = {name: dict(shape=list(val.shape), dtype=val.dtype.str)
+                                     for name, val in arrays.items()}
+        if set(arrays.keys()) != set(self.names):
+            raise KeyError('Expected arrays {}, got {}'.format(self.names, list(arrays.keys())))
+        iPoint = len(self)
+        iChunk, iRow = divmod(iPoint, self.chunk_size)
+        for name, val in arrays.items():
+            chunk = self._chunk(name, iChunk, writing=True)
+            chunk[iRow] = val
+            chunk.flush()
+        self._index['params'].append(json.loads(json.dumps(dict(params), default=_to_json)))
+        self._write_index()
+        return iPoint
+
+    def __getitem__(self, iPoint):
+        ''' Dict of read-only memory-mapped arrays for one point '''
+        if iPoint < 0:
+            iPoint += len(self)
+        if not 0 <= iPoint < len(self):
+            raise IndexError('Point {} not in store of length {}'.format(iPoint, len(self)))
+        iChunk, iRow = divmod(iPoint, self.chunk_size)
+        return {name: self._chunk(name, iChunk)[iRow] for name in self.names}
+
+    def stack(self, name, indices=None):
+        ''' One array over points, shape (n_points, ...). Only the chunks needed are read '''
+        if indices is None:
+            indices = range(len(self))
+        return np.array([self[iPoint][name] for iPoint in indices])
+
+    def find(self, **params):
+        ''' Indices of the points whose parameters match all of these '''
+        return [iPoint for iPoint, point_params in enumerate(self.params)
+                if all(_matches(point_params.get(k), v) for k, v in params.items())]
+
+
+def _matches(stored, wanted):
+    if isinstance(stored, float) and isinstance(wanted, float):
+        return bool(np.isclose(stored, wanted))
+    return stored == wanted
+
+
+def _to_json(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return repr(obj)
+
+
+class _LightlabStandIn(object):
+    # Holds the state of a pickled lightlab object, so lightlab is not needed to convert
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+class _StandInUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module.startswith('lightlab') or module == '__main__':
+            return type(name, (_LightlabStandIn,), dict())
+        return super().find_class(module, name)
+
+
+def _bundle_rows(bundle):
+    return np.asarray(bundle.absc), np.asarray(bundle.ordiMat)
+
+
+def convert_pickle_gzip(filename, directory=None):
+    ''' Converts a ``(param_name, param_vals, (bundleR, bundleT))`` or ``(param_vals, bundle)`` pickle
+        saved with lightlab ``io.savePickleGzip`` into a ResultStore. Each FunctionBundle row becomes one point,
+        with arrays ``absc`` and ``R``, ``T`` (two bundles) or ``spectrum`` (one bundle).
+    '''
+    if directory is None:
+        directory = filename[:-len('.pkl.gz')] if filename.endswith('.pkl.gz') else filename + '.store'
+    with gzip.open(filename, 'rb') as fx:
+        contents = _StandInUnpickler(fx).load()
+    if len(contents) == 3:
+        param_name, param_vals, bundles = contents
+    else:
+        param_name = 'param'
+        param_vals, bundles = contents
+    if isinstance(bundles, (tuple, list)):
+        names = ['R', 'T'] if len(bundles) == 2 else ['spectrum{}'.format(i) for i in range(len(bundles))]
+    else:
+        bundles = [bundles]
+        names = ['spectrum']
+    rows = [_bundle_rows(bundle) for bundle in bundles]
+    store = ResultStore(directory)
+    if len(store) > 0:
+        raise FileExistsError('{} already has results'.format(directory))
+    for iPoint, param_val in enumerate(param_vals):
+        arrays = {name: ordi[iPoint] for name, (_, ordi) in zip(names, rows)}
+        arrays['absc'] = rows[0][0]
+        store.append({param_name: param_val}, **arrays)
+    return store
@@ -0,0 +1,258 @@
+''' Cheap alternatives to many-frequency DFT flux monitors.
+
+    Every frequency of a flux monitor keeps complex field sums over the whole monitor plane, updated every step.
+    These tools trade that memory for post-processing:
+
+    * ``aaa_interpolant``: rational (Pade-like) interpolation of a spectrum sampled at few frequencies,
+      with a ``cubic_spline`` fallback when the rational fit is not trustworthy
+    * ``TimeSeriesMonitor``: records one field component at one point, then Fourier transforms afterwards
+    * ``flux_monitor_cost``: memory and per-step work of a DFT monitor, for comparing the options
+    * ``SpectralConvergence``: stop condition for when the DFT flux spectra stop changing
+'''
+import numpy as np
+
+
+def cubic_spline(x, y):
+    ''' Natural cubic spline through samples y(x), x increasing. Returns a function like aaa_interpolant does '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y)
+    h = np.diff(x)
+    # second derivatives at the samples, zero at both ends
+    system = np.zeros((len(x), len(x)))
+    rhs = np.zeros(len(x), dtype=y.dtype if np.iscomplexobj(y) else float)
+    system[0, 0] = system[-1, -1] = 1
+    for i in range(1, len(x) - 1):
+        system[i, i - 1:i + 2] = h[i - 1] / 6, (h[i - 1] + h[i]) / 3, h[i] / 6
+        rhs[i] = (y[i + 1] - y[i]) / h[i] - (y[i] - y[i - 1]) / h[i - 1]
+    curvature = np.linalg.solve(system, rhs) if len(x) > 2 else np.zeros_like(rhs)
+
+    def spline(xx):
+        xx = np.real(np.asarray(xx))
+        i = np.clip(np.searchsorted(x, xx) - 1, 0, len(x) - 2)
+        a, b = (x[i + 1] - xx) / h[i], (xx - x[i]) / h[i]
+        return (a * y[i] + b * y[i + 1]
+                + ((a ** 3 - a) * curvature[i] + (b ** 3 - b) * curvature[i + 1]) * h[i] ** 2 / 6)
+    return spline
+
+
+def aaa_poles(zj, fj, weights):
+    ''' Poles and residues of the barycentric rational function with support points zj, values fj and weights '''
+    # The poles are the roots of sum(weights / (z - zj)). In the basis of the vectors orthogonal to weights
+    # (an eigenproblem of size len(zj) - 1), they are the eigenvalues of the matrix below
+    if len(zj) < 2:
+        return np.zeros(0, dtype=complex), np.zeros(0, dtype=complex)
+    orth = np.linalg.svd(weights[None, :])[2][1:].conj().T
+    diag_orth = zj[:, None] * orth
+    total = np.sum(weights)
+    total = total if total != 0 else np.finfo(float).eps
+    reduced = orth.conj().T @ diag_orth - np.outer(orth.conj().T @ np.ones(len(zj)), weights @ diag_orth) / total
+    poles = np.linalg.eigvals(reduced)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cauchy = 1 / (poles[:, None] - zj[None, :])
+        residues = (cauchy @ (weights * fj)) / -(cauchy ** 2 @ weights)
+    return poles, residues
+
+
+def aaa_interpolant(z, f, tol=1e-4, max_terms=50, verbose=False):
+    ''' Rational interpolant of samples f(z), by the AAA algorithm (Nakatsukasa, Sete, Trefethen 2018).
+        Resonances are poles, so a few dozen samples capture peaks that would need many uniform points.
+        Returns a function that can be evaluated on any array of frequencies.
+
+        Simulated spectra are noisy at about 1e-4 of their maximum, so the fit stops at tol * max|f| rather than
+        fitting the noise, which makes spurious pole-zero pairs (Froissart doublets). The result falls back to
+        ``cubic_spline`` if the fit does not reach tol, or if it has a pole that the samples cannot support:
+        one whose residue is below the noise, or one that is closer to the sampled interval than the sample spacing.
+        Compare against a dense run (``bragg_setups.check_sparse``) before trusting it for a new kind of spectrum
+    '''
+    z = np.asarray(z, dtype=complex)
+    f = np.asarray(f, dtype=complex)
+    real_valued = np.all(np.isreal(f))
+    scale = np.max(np.abs(f)) if len(f) else 0
+    if len(z) < 4 or scale == 0:
+        return cubic_spline(z.real, f.real if real_valued else f)
+    remaining = np.ones(len(z), dtype=bool)
+    approx = np.full(len(z), np.mean(f))
+    support = []
+    converged = False
+    for _ in range(min(max_terms, len(z) - 1)):
+        j = int(np.argmax(np.where(remaining, np.abs(f - approx), -1)))
+        support.append(j)
+        remaining[j] = False
+        zj, fj = z[support], f[support]
+        cauchy = 1 / (z[remaining, None] - zj[None, :])
+        loewner = (f[remaining, None] - fj[None, :]) * cauchy
+        _, _, vh = np.linalg.svd(loewner, full_matrices=False)
+        weights = vh[-1].conj()
+        approx = f.copy()
+        approx[remaining] = (cauchy @ (weights * fj)) / (cauchy @ weights)
+        if np.max(np.abs(f - approx)) <= tol * scale:
+            # fewer support points than samples, so the fit is not simply interpolating the noise
+            converged = np.count_nonzero(remaining) >= len(support)
+            break
+    zj, fj = z[support], f[support]
+
+    poles, residues = aaa_poles(zj, fj, weights)
+    spacing = np.min(np.diff(np.sort(z.real)))
+    z_min, z_max = np.min(z.real), np.max(z.real)
+    # distance of each pole to the sampled interval of the real axis
+    distance = np.abs(poles - np.clip(poles.real, z_min, z_max))
+    spurious = (np.abs(residues) < tol * scale * np.maximum(distance, spacing)) | (distance < spacing)
+    if not converged or np.any(spurious):
+        if verbose:
+            print('aaa_interpolant: {}, using a cubic spline'.format(
+                  '{} spurious poles'.format(np.count_nonzero(spurious)) if converged else 'no fit within tol'))
+        return cubic_spline(z.real, f.real if real_valued else f)
+
+    def interpolant(zz):
+        zz = np.asarray(zz, dtype=complex)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cauchy = 1 / (zz[..., None] - zj)
+            vals = (cauchy @ (weights * fj)) / (cauchy @ weights)
+        # exactly at a support point
+        hit_zz, hit_j = np.nonzero(zz[..., None] == zj)
+        vals[hit_zz] = fj[hit_j]
+        return vals.real if real_valued else vals
+    interpolant.poles, interpolant.residues = poles, residues
+    return interpolant
+
+
+class TimeSeriesMonitor(object):
+    ''' Records one field component at one point on every call. Pass its ``step`` to ``sim.run``.
+
+        Memory is one complex number per step, independent of how many frequencies you want afterwards.
+        ``spectrum`` gives the power spectral density, which is proportional to flux for a single-mode waveguide,
+        so ratios against a reference run (transmission) are meaningful.
+    '''
+    def __init__(self, component, point):
+        self.component = component
+        self.point = point
+        self.times = []
+        self.values = []
+        self._minus = None
+
+    def __call__(self, sim):
+        self.times.append(sim.meep_time())
+        self.values.append(sim.get_field_point(self.component, self.point))
+
+    @property
+    def step(self):
+        ''' This monitor as a plain function. meep calls step functions by their argument count '''
+        def step(sim):
+            self(sim)
+        return step
+
+    def series(self):
+        times, values = np.array(self.times), np.array(self.values)
+        if self._minus is not None:
+            ref_times, ref_values = self._minus
+            values = values - np.interp(times, ref_times, ref_values.real, right=0) \
+                            - 1j * np.interp(times, ref_times, ref_values.imag, right=0)
+        return times, values
+
+    def load_minus(self, reference):
+        # subtracts a reference (times, values), such as the incident pulse, like load_minus_flux_data
+        self._minus = (np.asarray(reference[0]), np.asarray(reference[1]))
+
+    def amplitude(self, freqs, chunk_bytes=1 << 24):
+        times, values = self.series()
+        freqs = np.asarray(freqs)
+        amplitude = np.zeros(len(freqs), dtype=complex)
+        if len(times) < 2:
+            return amplitude
+        weighted = values * np.diff(times, prepend=times[0])
+        # a chunk of steps at a time, so the phase matrix stays small for long runs with many frequencies
+        chunk = max(1, chunk_bytes // (16 * max(len(freqs), 1)))
+        for i0 in range(0, len(times), chunk):
+            phases = np.exp(2j * np.pi * np.outer(freqs, times[i0:i0 + chunk]))
+            amplitude += phases @ weighted[i0:i0 + chunk]
+        return amplitude
+
+    def spectrum(self, freqs):
+        return np.abs(self.amplitude(freqs)) ** 2
+
+    @property
+    def memory(self):
+        # bytes, grows with the number of steps
+        return 24 * len(self.values)
+
+
+def flux_monitor_cost(n_points, n_freqs, n_components=4):
+    ''' Storage (bytes) and work per time step (complex multiply-adds) of one DFT flux monitor.
+        n_points is the number of grid points in the monitor plane. Each point stores every
+        tangential E and H component (n_components) at every frequency as a complex double.
+    '''
+    return dict(memory=16 * n_points * n_components * n_freqs,
+                ops_per_step=n_points * n_components * n_freqs)
+
+
+class SpectralConvergence(object):
+    ''' Stop condition that stops a run once the DFT flux spectra stop changing. Use it like
+        ``stop_when_fields_decayed``::
+
+            sim.run(until_after_sources=SpectralConvergence([refl, tran], interval=20, tol=1e-3, min_time=100))
+
+        Every ``interval`` meep time units, the spectra of all the fluxes are read. Each monitor's change since
+        the last check is taken relative to that monitor's peak, within ``band`` (f_min, f_max) if given.
+        The run stops after ``patience`` checks in a row where every monitor changed by less than ``tol``,
+        and at least ``min_time`` after the first check, which should cover the pulse crossing the device.
+        ``max_time`` (also counted from the first check) stops it regardless.
+        Low-Q devices stop as soon as their spectra settle, while high-Q resonances keep running until resolved.
+        ``history`` has (meep time, change) of every check, and ``converged`` says whether it stopped by tol
+    '''
+    def __init__(self, fluxes, interval=20, tol=1e-3, band=None, patience=2, min_time=0, max_time=None, verbose=True):
+        self.fluxes = fluxes
+        self.interval = interval
+        self.tol = tol
+        self.band = band
+        self.patience = patience
+        self.min_time = min_time
+        self.max_time = max_time
+        self.verbose = verbose
+        self.history = []
+        self.converged = False
+        self._t_first = None
+        self._next_check = None
+        self._last = None
+        self._n_converged = 0
+
+    def _spectra(self):
+        import meep as mp
+        spectra = []
+        for flux in self.fluxes:
+            vals = np.asarray(mp.get_fluxes(flux))
+            if self.band is not None:
+                freqs = np.asarray(mp.get_flux_freqs(flux))
+                vals = vals[(freqs >= self.band[0]) & (freqs <= self.band[1])]
+            spectra.append(vals)
+        return spectra
+
+    def change(self, spectra):
+        # largest relative change of any monitor since the last check. nan while a monitor is still all zeros
+        changes = []
+        for now, last in zip(spectra, self._last):
+            scale = np.max(np.abs(now)) if len(now) > 0 else 0
+            changes.append(np.max(np.abs(now - last)) / scale if scale > 0 else np.nan)
+        return max(changes) if not np.any(np.isnan(changes)) else np.nan
+
+    def __call__(self, sim):
+        t = sim.meep_time()
+        if self._t_first is None:
+            self._t_first = t
+            self._next_check = t
+        if self.max_time is not None and t - self._t_first >= self.max_time:
+            if self.verbose:
+                print('Spectra not converged to {} by t = {:.1f} (max_time)'.format(self.tol, t))
+            return True
+        if t < self._next_check:
+            return False
+        self._next_check = t + self.interval
+        spectra = self._spectra()
+        if self._last is not None:
+            change = self.change(spectra)
+            self.history.append((t, change))
+            self._n_converged = self._n_converged + 1 if change < self.tol else 0
+        self._last = spectra
+        self.converged = self._n_converged >= self.patience and t - self._t_first >= self.min_time
+        if self.converged and self.verbose:
+            print('Spectra converged to {} at t = {:.1f} after {} checks'.format(self.tol, t, len(self.history)))
+        return self.converged
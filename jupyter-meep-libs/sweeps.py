@@ -0,0 +1,317 @@
+''' Parameter sweeps with one MEEP simulation per process.
+
+    The concept: scatter parameter points to a pool of worker processes, let the OS schedule them
+    on the multi-core machine, and gather results as they finish. MPI/OpenMP parallelism inside
+    one simulation does not help much for small sweeps, so each worker gets a small core budget instead.
+
+    Usage, with the Bragg example::
+
+        from bragg_setups import do_simrun
+        grid = param_grid(duty=[.4, .5, .6], dw=[.2, .3])
+        for params, spectra in sweep(do_simrun, grid, cores_per_worker=2, do_live=False):
+            plt.plot(spectra['freqs'], spectra['tran'])
+
+    Workers are started with "spawn", so that each one loads meep with its own thread budget.
+    The factory must then be picklable, so define it in a module, not in the notebook.
+    ``mp_context='fork'`` (linux) also takes notebook functions, but ignores ``cores_per_worker``.
+'''
+import os
+import time
+import shutil
+import itertools
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import meep as mp
+from meep_nb import objview
+from results import ResultStore
+from caching import hash_key
+
+
+_thread_vars = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+
+def param_grid(**axes):
+    ''' Cartesian product of keyword axes, as a list of dicts.
+        ``param_grid(duty=[.4, .5], dw=[.2, .3])`` gives four points.
+    '''
+    names = list(axes.keys())
+    return [dict(zip(names, vals)) for vals in itertools.product(*axes.values())]
+
+
+def flux_spectra(sim, refl, tran):
+    ''' Picklable results of a reflection/transmission run, such as ``do_simrun`` returns '''
+    return dict(freqs=np.array(mp.get_flux_freqs(refl)),
+                refl=np.array(mp.get_fluxes(refl)),
+                tran=np.array(mp.get_fluxes(tran)))
+
+
+@contextmanager
+def thread_budget(n_threads):
+    ''' Sets the thread variables while worker processes start, so they inherit them.
+        OpenMP reads them when meep is loaded, which is too late for a forked process
+    '''
+    old_values = {var: os.environ.get(var) for var in _thread_vars}
+    os.environ.update({var: str(n_threads) for var in _thread_vars})
+    try:
+        yield
+    finally:
+        for var, value in old_values.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def _init_worker(core_blocks):
+    # Runs once in each worker. Pins to a block of cores
+    if core_blocks is not None and hasattr(os, 'sched_setaffinity'):
+        try:
+            os.sched_setaffinity(0, core_blocks.get_nowait())
+        except Exception:
+            pass  # more workers than blocks, let the OS schedule
+
+
+def run_point(factory, params, **common_kwargs):
+    ''' Runs one sweep point in the current process.
+
+        ``params`` is either a dict of keyword arguments or an ``objview`` geometry, which is passed as ``geo``.
+        If the factory returns ``(sim, refl, tran)``, it is converted to spectra with ``flux_spectra``.
+        Otherwise the return value must be picklable.
+    '''
+    if isinstance(params, objview):
+        result = factory(geo=params, **common_kwargs)
+    else:
+        result = factory(**common_kwargs, **params)
+    if isinstance(result, tuple) and len(result) == 3 and isinstance(result[0], mp.Simulation):
+        result = flux_spectra(*result)
+    return result
+
+
+def _core_blocks(ctx, n_workers, cores_per_worker):
+    if not hasattr(os, 'sched_getaffinity'):
+        return None
+    cores = sorted(os.sched_getaffinity(0))
+    blocks = ctx.Queue()
+    for iWorker in range(n_workers):
+        block = cores[iWorker * cores_per_worker:(iWorker + 1) * cores_per_worker]
+        if len(block) == 0:
+            break
+        blocks.put(set(block))
+    return blocks
+
+
+def sweep(factory, grid, n_workers=None, cores_per_worker=1, mp_context=None, **common_kwargs):
+    ''' Runs ``factory`` on every point of ``grid`` in a process pool.
+
+        This is a generator that yields ``(params, result)`` in order of completion, not grid order.
+        Identical points are only simulated once.
+        Extra keyword arguments are passed to every point, such as ``do_live=False``.
+
+        Args:
+            factory (callable): such as ``bragg_setups.do_simrun``
+            grid (list): of dicts (see ``param_grid``) or of ``objview``
+            n_workers (int): defaults to filling the machine with ``cores_per_worker`` cores each
+            cores_per_worker (int): thread budget and CPU affinity block of each worker
+            mp_context (str): multiprocessing start method. Default is "spawn"
+    '''
+    for iPoint, result in _sweep_indexed(factory, grid, n_workers, cores_per_worker, mp_context, **common_kwargs):
+        yield grid[iPoint], result
+
+
+def _sweep_indexed(factory, grid, n_workers=None, cores_per_worker=1, mp_context=None, **common_kwargs):
+    # like sweep, but yields grid indices, which stay unique when the grid repeats an object
+    # identical points run once, and their result is yielded for each of them
+    groups = dict()
+    for iPoint, params in enumerate(grid):
+        key = _params_key(params)
+        try:
+            hash(key)
+        except TypeError:
+            key = ('unhashable', iPoint)  # runs on its own
+        groups.setdefault(key, []).append(iPoint)
+    if n_workers is None:
+        n_workers = max(1, (os.cpu_count() or 1) // cores_per_worker)
+    n_workers = min(n_workers, len(groups)) or 1
+    ctx = multiprocessing.get_context('spawn' if mp_context is None else mp_context)
+    blocks = _core_blocks(ctx, n_workers, cores_per_worker)
+    with thread_budget(cores_per_worker):
+        pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx,
+                                   initializer=_init_worker, initargs=(blocks, ))
+        # workers start on submit, so they all see the thread budget
+        futures = {pool.submit(run_point, factory, grid[group[0]], **common_kwargs): group
+                   for group in groups.values()}
+    with pool:
+        for fut in as_completed(futures):
+            result = fut.result()
+            for iPoint in futures[fut]:
+                yield iPoint, result
+
+
+def _params_key(params):
+    return params.key() if isinstance(params, objview) else objview(**params).key()
+
+
+def sweep_gather(factory, grid, **kwargs):
+    ''' Like ``sweep`` but blocks and returns results in grid order '''
+    results = [None] * len(grid)
+    for iPoint, result in _sweep_indexed(factory, grid, **kwargs):
+        results[iPoint] = result
+    return results
+
+
+class FieldCheckpointer(object):
+    ''' Step function that saves field state and DFT flux data every ``interval`` wall-clock seconds.
+
+        For very long single points. Before running a new simulation, ``restore`` resumes from the last checkpoint::
+
+            checkpointer = FieldCheckpointer('checkpoints/point3', [refl, tran], interval=600)
+            checkpointer.restore(sim)
+            sim.run(checkpointer.step, until=...)
+            checkpointer.clear()
+    '''
+    def __init__(self, directory, fluxes, interval=600):
+        self.directory = directory
+        self.fluxes = fluxes
+        self.interval = interval
+        self._next_save = time.time() + interval
+
+    def __call__(self, sim):
+        if time.time() < self._next_save:
+            return
+        self.save(sim)
+        self._next_save = time.time() + self.interval
+
+    @property
+    def step(self):
+        ''' This checkpointer as a plain function. meep calls step functions by their argument count '''
+        def step(sim):
+            self(sim)
+        return step
+
+    def save(self, sim):
+        tmp_dir = self.directory + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        sim.dump(tmp_dir, dump_structure=False, dump_fields=True)
+        arrays = dict(meep_time=np.array(sim.meep_time()))
+        for iFlux, flux in enumerate(self.fluxes):
+            fdata = sim.get_flux_data(flux)
+            arrays['E{}'.format(iFlux)] = np.asarray(fdata.E)
+            arrays['H{}'.format(iFlux)] = np.asarray(fdata.H)
+        np.savez(os.path.join(tmp_dir, 'fluxes.npz'), **arrays)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.replace(tmp_dir, self.directory)  # never leave a half-written checkpoint
+
+    def restore(self, sim):
+        ''' Loads the last checkpoint into sim, if there is one. Returns the meep time it resumes from, or None '''
+        flux_file = os.path.join(self.directory, 'fluxes.npz')
+        if not os.path.isfile(flux_file):
+            return None
+        sim.load(self.directory, load_structure=False, load_fields=True)
+        with np.load(flux_file) as npz:
+            for iFlux, flux in enumerate(self.fluxes):
+                fdata = mp.simulation.FluxData(E=npz['E{}'.format(iFlux)], H=npz['H{}'.format(iFlux)])
+                sim.load_flux_data(flux, fdata)
+            t_resume = float(npz['meep_time'])
+        print('Resumed from checkpoint at t = {:.1f}'.format(t_resume))
+        return t_resume
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ResumableSweep(object):
+    ''' A sweep that records each point to a ``ResultStore`` as it finishes, and skips finished points on restart.
+
+        The factory must return a dict of arrays, such as ``bragg_setups.normalized_run`` or ``flux_spectra``.
+        Points are identified by ``point_key(params)``, which should cover everything that changes the result.
+        If ``checkpoint_kwarg`` is given, each point also gets a checkpoint directory passed as that keyword,
+        so the factory can use ``FieldCheckpointer``. Usage::
+
+            runner = ResumableSweep('bragg-dw', normalized_run, param_grid(dw=[.2, .25, .3]))
+            runner.run(n_workers=3)  # rerun this cell after a kernel restart to pick up where it was
+            runner.progress()
+            spectra = runner.results()  # in grid order
+    '''
+    def __init__(self, directory, factory, grid, point_key=None, checkpoint_kwarg=None, **common_kwargs):
+        self.directory = directory
+        self.store = ResultStore(directory)
+        self.factory = factory
+        self.points = [{'geo': params} if isinstance(params, objview) else dict(params) for params in grid]
+        if point_key is None:
+            point_key = _default_point_key
+        self.keys = [point_key(params) for params in self.points]
+        self.checkpoint_kwarg = checkpoint_kwarg
+        self.common_kwargs = common_kwargs
+        self._t_start = None
+        self._n_done_at_start = 0
+
+    def done_keys(self):
+        return set(params.get('_key') for params in self.store.params)
+
+    def remaining(self):
+        # one (key, params) per unfinished key. Repeated grid points are run once, like in sweep
+        done = self.done_keys()
+        todo = []
+        for key, params in zip(self.keys, self.points):
+            if key not in done:
+                done.add(key)
+                todo.append((key, params))
+        return todo
+
+    def results(self):
+        ''' Results in grid order, read from the store. Repeated grid points share one row. None where not done '''
+        rows = {params.get('_key'): iRow for iRow, params in enumerate(self.store.params)}
+        return [self.store[rows[key]] if key in rows else None for key in self.keys]
+
+    def progress(self, verbose=True):
+        ''' Completion counts and an ETA based on the points finished in this session '''
+        n_total = len(set(self.keys))
+        n_done = len(self.done_keys() & set(self.keys))
+        stats = dict(done=n_done, total=n_total, fraction=n_done / max(n_total, 1), elapsed=0., eta=None)
+        if self._t_start is not None:
+            stats['elapsed'] = time.time() - self._t_start
+            n_session = n_done - self._n_done_at_start
+            if n_session > 0:
+                stats['eta'] = stats['elapsed'] / n_session * (n_total - n_done)
+        if verbose:
+            eta = 'unknown' if stats['eta'] is None else '{:.0f} s'.format(stats['eta'])
+            print('{}/{} points done ({:.0f}%), ETA {}'.format(n_done, n_total, 100 * stats['fraction'], eta))
+        return stats
+
+    def _with_checkpoint(self, key, params):
+        if self.checkpoint_kwarg is None:
+            return params
+        params = dict(params)
+        params[self.checkpoint_kwarg] = os.path.join(self.directory, 'checkpoints', key)
+        return params
+
+    def _record(self, key, params, result):
+        record = {k: (vars(v) if isinstance(v, objview) else v) for k, v in params.items() if k != self.checkpoint_kwarg}
+        record['_key'] = key
+        self.store.append(record, **result)
+
+    def run(self, n_workers=1, **sweep_kwargs):
+        ''' Runs the remaining points. With n_workers=1 it runs in this process (so liveplot works) '''
+        todo = self.remaining()
+        self._t_start = time.time()
+        self._n_done_at_start = len(self.done_keys() & set(self.keys))
+        self.progress()
+        if n_workers == 1:
+            for key, params in todo:
+                result = run_point(self.factory, self._with_checkpoint(key, params), **self.common_kwargs)
+                self._record(key, params, result)
+                self.progress()
+        else:
+            grid = [self._with_checkpoint(key, params) for key, params in todo]
+            for iPoint, result in _sweep_indexed(self.factory, grid, n_workers=n_workers,
+                                                 **sweep_kwargs, **self.common_kwargs):
+                self._record(todo[iPoint][0], grid[iPoint], result)
+                self.progress()
+        return self.store
+
+
+def _default_point_key(params):
+    return hash_key({k: (vars(v) if isinstance(v, objview) else v) for k, v in params.items()})
@@ -1,8 +1,15 @@
 import sys, os
-sys.path.append(os.path.join(os.path.dirname(__file__), '../../lib'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../jupyter-meep-libs'))
 from meep_nb import objview, silicon, oxide, liveplot
+from caching import cached_flux_reference, cached_timeseries_reference, hash_key
+from sweeps import FieldCheckpointer, ResumableSweep
+from spectra import TimeSeriesMonitor, SpectralConvergence, aaa_interpolant, flux_monitor_cost
+from background import launch
 import meep as mp
 import time
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+import numpy as np
 
 # geo is the parameters, while geometry is the MEEP geometry list
 default_geo = objview(
@@ -14,6 +21,8 @@ default_geo = objview(
                         buffer = 4,  # um
                         cavity = .5,  # ratio of pitch, such as 0.25
                         thickness = 0.,  # change to 0 for 2D
+                        geometry_mode = 'blocks',  # or 'prism' or 'grid'. See bragg_geometry
+                        grid_resolution = None,  # for geometry_mode 'grid'. Default is twice resolution
                        )
 
 
@@ -80,10 +89,11 @@ def sim_kwargs(geo=None, **kwargs):
     symms = [mp.Mirror(mp.Y, phase=-1)]
     if geo.thickness != 0:
         symms.append(mp.Mirror(mp.Z, phase=1))
+    setup = bragg_setup(geo)
     return dict(
-                  cell_size=bragg_cell(geo),
-                  geometry=bragg_geometry(geo),
-                  sources=bragg_source(geo),
+                  cell_size=setup['cell'],
+                  geometry=list(setup['geometry']),
+                  sources=list(setup['sources']),
                   boundary_layers=pml_layers,
                   resolution=resolution,
                   default_material=oxide,
@@ -92,6 +102,33 @@ def sim_kwargs(geo=None, **kwargs):
                   )
 
 
+def _setup_settings():
+    # module settings that the setup depends on, besides geo
+    return (resolution, fcen, df, nfreq, dpml, monitor_mode, sparse_nfreq, stopband)
+
+
+@lru_cache(maxsize=64)
+def _cached_setup(frozen_geo, settings):
+    geo = frozen_geo.copy()
+    flux_size = mp.Vector3(0, 2*geo.sm_width, 2*geo.thickness)
+    return dict(cell=bragg_cell(geo),
+                geometry=tuple(bragg_geometry(geo)),
+                sources=tuple(bragg_source(geo)),
+                refl_region=mp.FluxRegion(center=mp.Vector3(-monitor_x(geo), 0, 0), size=flux_size),
+                tran_region=mp.FluxRegion(center=mp.Vector3(monitor_x(geo), 0, 0), size=flux_size),
+                monitor_freqs=monitor_freqs())
+
+
+def bragg_setup(geo=None, **kwargs):
+    ''' Cell, geometry, sources and flux regions, memoized in a bounded LRU cache keyed on the frozen geo
+        and the module settings (resolution, fcen, ...). Repeated sweep points and re-plots reuse the same
+        meep objects instead of rebuilding hundreds of blocks, so do not modify them.
+        ``_cached_setup.cache_info()`` shows the hit rate
+    '''
+    geo = kwargs_to_geo(geo, **kwargs)
+    return _cached_setup(geo.freeze(), _setup_settings())
+
+
 def cell_x(geo=None, **kwargs):
     geo = kwargs_to_geo(geo, **kwargs)
     return geo.pitch * geo.n_periods + geo.cavity * geo.pitch + 2 * geo.buffer
@@ -105,7 +142,27 @@ def bragg_cell(geo=None, **kwargs):
     return cell
 
 
+def grating_profile(geo=None, **kwargs):
+    # Edges along x (length n+1) and waveguide widths (length n) of every tooth, including the cavity
+    geo = kwargs_to_geo(geo, **kwargs)
+    tooth_lens = np.tile([geo.pitch * geo.duty, geo.pitch * (1 - geo.duty)], geo.n_periods)
+    widths = np.tile([geo.sm_width + geo.dw / 2, geo.sm_width - geo.dw / 2], geo.n_periods)
+    if geo.n_periods > 0:
+        i_cavity = 2 * int(geo.n_periods / 2)
+        tooth_lens = np.insert(tooth_lens, i_cavity, geo.cavity * geo.pitch)
+        widths = np.insert(widths, i_cavity, geo.sm_width + geo.dw / 2)
+    x0 = geo.buffer - cell_x(geo)/2
+    edges = x0 + np.concatenate([[0], np.cumsum(tooth_lens)])
+    return edges, widths
+
+
 def bragg_geometry(geo=None, **kwargs):
+    ''' geo.geometry_mode selects how the teeth are represented
+            * 'blocks': one mp.Block per tooth
+            * 'prism': the whole grating is one prism with a corrugated outline
+            * 'grid': the grating is a binary mp.MaterialGrid sampled at grid_resolution.
+                Geometry init time is then nearly constant in n_periods
+    '''
     geo = kwargs_to_geo(geo, **kwargs)
     cellx = cell_x(geo)
 
@@ -115,77 +172,466 @@ def bragg_geometry(geo=None, **kwargs):
                                  center=mp.Vector3((cellx - geo.buffer) * side_sign/2),
                                  material=silicon))
     # the teeth of the grating
-    x0 = geo.buffer - cellx/2
-    for iPeriod in range(geo.n_periods):
-        if iPeriod == int(geo.n_periods / 2):
-            tooth_len = geo.cavity * geo.pitch
-            wg_wid = geo.sm_width + geo.dw / 2
-            geometry.append(mp.Block(mp.Vector3(tooth_len, wg_wid, geo.thickness),
-                                     center=mp.Vector3(x0 + tooth_len/2),
-                                     material=silicon))
-            x0 += tooth_len
-        for iTooth in range(2):
-            tooth_len = geo.pitch * (geo.duty if iTooth == 0 else (1 - geo.duty))
-            wg_wid = geo.sm_width + geo.dw / 2 * (1 if iTooth == 0 else -1)
-            geometry.append(mp.Block(mp.Vector3(tooth_len, wg_wid, geo.thickness),
-                                     center=mp.Vector3(x0 + tooth_len/2),
+    edges, widths = grating_profile(geo)
+    if len(widths) == 0:
+        return geometry
+    if geo.geometry_mode == 'blocks':
+        for x0, x1, wg_wid in zip(edges[:-1], edges[1:], widths):
+            geometry.append(mp.Block(mp.Vector3(x1 - x0, wg_wid, geo.thickness),
+                                     center=mp.Vector3((x0 + x1) / 2),
                                      material=silicon))
-            x0 += tooth_len
+    elif geo.geometry_mode == 'prism':
+        # merge teeth of equal width (such as the cavity) so there are no repeated vertices
+        nonzero = edges[1:] > edges[:-1]
+        edges = np.append(edges[:-1][nonzero], edges[-1])
+        widths = widths[nonzero]
+        changes = np.concatenate([[True], widths[1:] != widths[:-1]])
+        edges = np.append(edges[:-1][changes], edges[-1])
+        widths = widths[changes]
+        top = np.stack([np.repeat(edges, 2)[1:-1], np.repeat(widths / 2, 2)], axis=1)
+        outline = np.concatenate([top, top[::-1] * [1, -1]])
+        # in 2D the height is the cell's z size, 0, like the other 2D prisms in this repo
+        vertices = [mp.Vector3(x, y, -geo.thickness / 2) for x, y in outline.tolist()]
+        geometry.append(mp.Prism(vertices, height=geo.thickness, material=silicon))
+    elif geo.geometry_mode == 'grid':
+        grid_res = geo.grid_resolution if geo.grid_resolution is not None else 2 * resolution
+        grating_len = edges[-1] - edges[0]
+        grating_wid = np.max(widths)
+        nx = max(1, int(np.ceil(grating_len * grid_res)))
+        ny = max(1, int(np.ceil(grating_wid * grid_res)))
+        x_samples = edges[0] + (np.arange(nx) + .5) * grating_len / nx
+        y_samples = (np.arange(ny) + .5) * grating_wid / ny - grating_wid / 2
+        i_tooth = np.clip(np.searchsorted(edges, x_samples, side='right') - 1, 0, len(widths) - 1)
+        weights = (np.abs(y_samples)[None, :] <= widths[i_tooth][:, None] / 2).astype(float)
+        grid = mp.MaterialGrid(mp.Vector3(nx, ny, 1), oxide, silicon, weights=weights, do_averaging=False)
+        geometry.append(mp.Block(mp.Vector3(grating_len, grating_wid, geo.thickness),
+                                 center=mp.Vector3((edges[0] + edges[-1]) / 2),
+                                 material=grid))
+    else:
+        raise ValueError('Unknown geometry_mode {}'.format(geo.geometry_mode))
     return geometry
 
 
+def benchmark_geometry(n_periods_list=(10, 30, 100, 300), modes=('blocks', 'prism', 'grid'), geo=None, **kwargs):
+    ''' Times geometry construction plus init_sim for each representation. Returns {mode: [seconds, ...]}.
+        At the first n_periods, it also checks that each mode gives the same epsilon as 'blocks'.
+        'grid' differs at the tooth edges, where it has no subpixel averaging
+    '''
+    timings = {mode: [] for mode in modes}
+    epsilons = dict()
+    for mode in modes:
+        for n_periods in n_periods_list:
+            t0 = time.time()
+            sim = mp.Simulation(progress_interval=1e6,
+                                **sim_kwargs(geo=geo, n_periods=n_periods, geometry_mode=mode, **kwargs))
+            sim.init_sim()
+            timings[mode].append(time.time() - t0)
+            if n_periods == n_periods_list[0]:
+                epsilons[mode] = sim.get_array(center=mp.Vector3(), size=sim.cell_size, component=mp.Dielectric)
+            sim.reset_meep()
+            print('{:>7s} n_periods = {:4d}: {:.2f} s'.format(mode, n_periods, timings[mode][-1]))
+    if 'blocks' in epsilons:
+        for mode, eps in epsilons.items():
+            if mode != 'blocks':
+                diff = np.abs(eps - epsilons['blocks'])
+                print('{:>7s} epsilon vs blocks at n_periods = {}: max difference {:.3g}, {:.2%} of pixels differ'
+                      .format(mode, n_periods_list[0], np.max(diff), np.mean(diff > 1e-6)))
+    return timings
+
+
 def monitor_x(geo=None, **kwargs):
     geo = kwargs_to_geo(geo, **kwargs)
     return cell_x(geo) / 2 - dpml - .5
 
 
-def add_monitors(simulation, geo=None, **kwargs):
+monitor_mode = 'uniform'  # or 'sparse', 'nonuniform', 'timeseries'. See add_monitors
+sparse_nfreq = 41  # frequencies actually monitored in 'sparse' mode
+sparse_tol = 1e-4  # relative noise level of the sparse spectra. AAA fits stop there, see spectra.aaa_interpolant
+stopband = None  # (f_min, f_max) where 'nonuniform' monitors concentrate. Default is the middle fifth of the band
+
+
+def monitor_freqs(mode=None):
+    # The frequencies that the DFT monitors accumulate, for each mode. 'uniform' is nfreq across (fcen, df)
+    mode = monitor_mode if mode is None else mode
+    f_min, f_max = fcen - df / 2, fcen + df / 2
+    if mode == 'sparse':
+        return np.linspace(f_min, f_max, sparse_nfreq)
+    elif mode == 'nonuniform':
+        band = stopband if stopband is not None else (fcen - df / 10, fcen + df / 10)
+        n_dense = max(nfreq // 5, 2)
+        return np.union1d(np.linspace(f_min, f_max, sparse_nfreq), np.linspace(band[0], band[1], n_dense))
+    return np.linspace(f_min, f_max, nfreq)
+
+
+def add_monitors(simulation, geo=None, mode=None, **kwargs):
+    ''' Reflection and transmission monitors. mode (default is the global monitor_mode) selects
+            * 'uniform': nfreq DFT frequencies across the band, as before
+            * 'sparse': sparse_nfreq DFT frequencies. monitor_spectra interpolates to nfreq afterwards (AAA)
+            * 'nonuniform': sparse across the band plus dense within the stopband
+            * 'timeseries': no DFT. Ey is recorded at the center of each monitor and transformed afterwards.
+                These are step functions, which do_simrun passes to sim.run
+        See monitor_cost for what each one costs
+    '''
     geo = kwargs_to_geo(geo, **kwargs)
+    mode = monitor_mode if mode is None else mode
+
+    if mode == 'timeseries':
+        return (TimeSeriesMonitor(mp.Ey, mp.Vector3(-monitor_x(geo), 0, 0)),
+                TimeSeriesMonitor(mp.Ey, mp.Vector3(monitor_x(geo), 0, 0)))
+
+    # reflected and transmitted flux
+    setup = bragg_setup(geo)
+    refl_fr, tran_fr = setup['refl_region'], setup['tran_region']
+    if mode == 'uniform':
+        refl = simulation.add_flux(fcen, df, nfreq, refl_fr)
+        tran = simulation.add_flux(fcen, df, nfreq, tran_fr)
+    else:
+        freqs = setup['monitor_freqs'] if mode == monitor_mode else monitor_freqs(mode)
+        refl = simulation.add_flux(freqs, refl_fr)
+        tran = simulation.add_flux(freqs, tran_fr)
 
-    # reflected flux
-    refl_fr = mp.FluxRegion(center=mp.Vector3(-monitor_x(geo) ,0, 0),
-                            size=mp.Vector3(0, 2*geo.sm_width, 2*geo.thickness))
-    refl = simulation.add_flux(fcen, df, nfreq, refl_fr)
+    return refl, tran
 
-    # transmitted flux
-    tran_fr = mp.FluxRegion(center=mp.Vector3(monitor_x(geo) ,0, 0),
-                            size=mp.Vector3(0, 2*geo.sm_width, 2*geo.thickness))
-    tran = simulation.add_flux(fcen, df, nfreq, tran_fr)
 
-    return refl, tran
+def monitor_cost(geo=None, mode=None, n_steps=20000, verbose=True, **kwargs):
+    ''' Estimated memory (bytes) and per-step work of both monitors. Timeseries memory grows with n_steps.
+        With verbose, prints a comparison of all modes
+    '''
+    geo = kwargs_to_geo(geo, **kwargs)
+    n_points = max(1, round(2 * geo.sm_width * resolution)) * max(1, round(2 * geo.thickness * resolution))
+    costs = dict()
+    for this_mode in ['uniform', 'sparse', 'nonuniform', 'timeseries']:
+        if this_mode == 'timeseries':
+            costs[this_mode] = dict(n_freqs=0, memory=2 * 24 * n_steps, ops_per_step=2)
+        else:
+            n_freqs = len(monitor_freqs(this_mode))
+            one = flux_monitor_cost(n_points, n_freqs, n_components=4 if geo.thickness != 0 else 2)
+            costs[this_mode] = dict(n_freqs=n_freqs, memory=2 * one['memory'], ops_per_step=2 * one['ops_per_step'])
+    if verbose:
+        for this_mode, cost in costs.items():
+            print('{:>10s}: {:5d} DFT freqs, {:9.2f} MB, {:10d} ops/step'.format(
+                  this_mode, cost['n_freqs'], cost['memory'] / 1e6, cost['ops_per_step']))
+    mode = monitor_mode if mode is None else mode
+    return costs[mode]
+
+
+def monitor_spectra(refl, tran, mode=None):
+    ''' Raw reflected and transmitted spectra on nfreq uniform frequencies (for 'nonuniform': on its own frequencies).
+        Returns a dict of freqs, refl, tran
+    '''
+    mode = monitor_mode if mode is None else mode
+    dense_freqs = np.linspace(fcen - df / 2, fcen + df / 2, nfreq)
+    if mode == 'timeseries':
+        return dict(freqs=dense_freqs, refl=refl.spectrum(dense_freqs), tran=tran.spectrum(dense_freqs))
+    freqs = np.array(mp.get_flux_freqs(refl))
+    spectra = dict(freqs=freqs, refl=np.array(mp.get_fluxes(refl)), tran=np.array(mp.get_fluxes(tran)))
+    if mode == 'sparse':
+        spectra = densify(spectra)
+    return spectra
+
+
+def densify(spectra):
+    # interpolates every spectrum in the dict onto nfreq uniform frequencies with a rational interpolant,
+    # or a spline where the rational fit is not trustworthy
+    dense_freqs = np.linspace(fcen - df / 2, fcen + df / 2, nfreq)
+    dense = dict(freqs=dense_freqs)
+    for name, vals in spectra.items():
+        if name != 'freqs':
+            dense[name] = aaa_interpolant(spectra['freqs'], vals, tol=sparse_tol)(dense_freqs)
+    return dense
+
+
+def check_sparse(geo=None, **kwargs):
+    ''' Runs the device with 'uniform' and then 'sparse' monitors and compares the spectra on the nfreq frequencies.
+        Returns the largest difference of refl and tran, relative to the largest uniform value
+    '''
+    spectra = dict()
+    for mode in ['uniform', 'sparse']:
+        with fidelity(monitor_mode=mode):
+            sim, refl, tran = do_simrun(do_live=False, geo=geo, **kwargs)
+            spectra[mode] = monitor_spectra(refl, tran)
+    errors = dict()
+    for name in ['refl', 'tran']:
+        dense = spectra['uniform'][name]
+        errors[name] = np.max(np.abs(spectra['sparse'][name] - dense)) / np.max(np.abs(dense))
+        print('{}: sparse differs from uniform by {:.2e}'.format(name, errors[name]))
+    return errors
 
 
 def livefield(sim):
     liveplot(sim, mp.Ey)
 
 
-def monitor_until(geo=None, until=None, **kwargs):
+stop_mode = 'decay'  # or 'spectral', which stops when the DFT spectra converge. See monitor_until
+spectral_tol = 1e-3  # relative change of the spectra over spectral_interval
+spectral_interval = 20
+spectral_band = None  # (f_min, f_max) where convergence is checked, such as the stopband. Default is all
+spectral_max_factor = 5  # the spectral stop gives up after this many times its minimum run time
+
+
+def min_run_time(geo=None, **kwargs):
+    # time for light to cross the whole cell twice at the silicon group index
+    geo = kwargs_to_geo(geo, **kwargs)
+    return 2 * cell_x(geo) * np.sqrt(silicon.epsilon_diag.x)
+
+
+def expected_end_time(geo=None, until=None, **kwargs):
+    ''' Meep time a do_simrun is expected to reach, for progress ETAs. With until, that.
+        Otherwise the end of the Gaussian source (meep's default cutoff of 5 widths on each side of the peak)
+        plus min_run_time. A field-decay stop usually runs a little longer
+    '''
+    if until is not None:
+        return until
+    return 10 / df + min_run_time(geo, **kwargs)
+
+
+def monitor_until(geo=None, until=None, fluxes=None, **kwargs):
+    ''' Stop condition keyword for sim.run. With stop_mode 'spectral' and DFT fluxes given (refl, tran),
+        the run stops once their spectra converge (spectra.SpectralConvergence).
+        It runs at least long enough for light to cross the whole cell twice at the silicon group index,
+        and at most spectral_max_factor times that. do_simrun keeps the stop condition as sim.stop_condition
+    '''
     geo = kwargs_to_geo(geo, **kwargs)
     stop_kwarg = dict()
-    if until is None:
+    if until is not None:
+        stop_kwarg['until'] = until
+    elif stop_mode == 'spectral' and fluxes is not None:
+        min_time = min_run_time(geo)
+        stop_kwarg['until_after_sources'] = SpectralConvergence(fluxes, interval=spectral_interval, tol=spectral_tol,
+                                                                band=spectral_band, min_time=min_time,
+                                                                max_time=spectral_max_factor * min_time)
+    else:
         monitor_point = mp.Vector3(monitor_x(geo), 0, 0)
         stop_kwarg['until_after_sources'] = mp.stop_when_fields_decayed(20, mp.Ey, monitor_point, 1e-3)
-    else:
-        stop_kwarg['until'] = until
     return stop_kwarg
 
 
-def do_simrun(base_refl_data=None, do_live=True, geo=None, **kwargs):
+def do_simrun(base_refl_data=None, do_live=True, geo=None, checkpoint_dir=None, checkpoint_interval=600, profile=None,
+              step_funcs=(), **kwargs):
+    # profile is an optional profiling.RunProfile, filled with the time and memory of each phase.
+    # Without one, the simulation is initialized and run as usual.
+    # step_funcs are passed on to sim.run, such as the reporter of background.launch
+    with profile.phase('geometry') if profile is not None else nullcontext():
+        simulation_kwargs = sim_kwargs(geo=geo, **kwargs)
     sim = mp.Simulation(
                         progress_interval=1e6 if do_live else 4,
-                        **sim_kwargs(geo=geo, **kwargs))
+                        **simulation_kwargs)
     sim.reset_meep()
 
     # Now put in some flux monitors. Make sure the pulse source was selected
-    refl, tran = add_monitors(sim)
+    refl, tran = add_monitors(sim, geo=geo, **kwargs)
+    if profile is not None:
+        profile.init(sim)
 
     # for normal run, load negated fields to subtract incident from refl. fields
     if base_refl_data is not None:
-        sim.load_minus_flux_data(refl, base_refl_data)
+        if isinstance(refl, TimeSeriesMonitor):
+            refl.load_minus(base_refl_data)
+        else:
+            sim.load_minus_flux_data(refl, base_refl_data)
 
     run_args = (mp.at_beginning(livefield), mp.at_every(5, livefield), ) if do_live else tuple()
+    run_args += tuple(step_funcs)
+    if isinstance(refl, TimeSeriesMonitor):
+        run_args += (refl.step, tran.step)
+    if checkpoint_dir is not None:
+        # for very long points: periodically save fields and resume from them after a restart
+        dft_fluxes = [] if isinstance(refl, TimeSeriesMonitor) else [refl, tran]
+        checkpointer = FieldCheckpointer(checkpoint_dir, dft_fluxes, interval=checkpoint_interval)
+        checkpointer.restore(sim)
+        run_args += (checkpointer.step, )
     t0 = time.time()
-    sim.run(*run_args,
-            **monitor_until(geo=geo, **kwargs))
-    print('Realtime duration = {:.2f} seconds'.format(time.time() - t0))
+    step0 = sim.timestep() if sim.fields is not None else 0
+    dft_fluxes = None if isinstance(refl, TimeSeriesMonitor) else [refl, tran]
+    stop_kwarg = monitor_until(geo=geo, fluxes=dft_fluxes, **kwargs)
+    # such as a SpectralConvergence, whose history shows how the spectra settled
+    sim.stop_condition = stop_kwarg.get('until_after_sources')
+    if profile is not None:
+        profile.run(sim, *run_args, **stop_kwarg)
+    else:
+        sim.run(*run_args, **stop_kwarg)
+    duration = time.time() - t0
+    print('Realtime duration = {:.2f} seconds ({:.0f} steps/s)'.format(duration, (sim.timestep() - step0) / duration))
+    if checkpoint_dir is not None:
+        checkpointer.clear()
     return sim, refl, tran
+
+
+def reference_geo(geo=None, **kwargs):
+    # Straight waveguide with the same cell, source and monitors. Parameters that only change the device are normalized
+    ref_geo = kwargs_to_geo(geo, **kwargs)
+    ref_geo.update(dw=0, duty=.5, geometry_mode='blocks', grid_resolution=None)
+    return ref_geo
+
+
+def reference_run(geo=None, use_cache=True, step_funcs=(), **kwargs):
+    ''' Normalization run on a straight waveguide, cached on disk.
+        Sweeps over duty and dw reuse one reference. Returns (straight_refl_data, straight_tran_flux).
+        For 'timeseries' monitors, straight_refl_data is the reflection monitor's (times, values)
+        and straight_tran_flux is the transmitted spectrum on monitor_freqs()
+    '''
+    until = kwargs.pop('until', None)
+    ref_geo = reference_geo(geo, **kwargs)
+    key_parts = (sorted(vars(ref_geo).items()), fcen, df, nfreq, resolution, dpml, until,
+                 monitor_mode, list(monitor_freqs()), stop_mode, spectral_tol, spectral_interval, spectral_band)
+    run_reference = lambda: do_simrun(do_live=False, geo=ref_geo, until=until, step_funcs=step_funcs)
+    if monitor_mode == 'timeseries':
+        return cached_timeseries_reference(run_reference, key_parts, monitor_freqs(), use_cache=use_cache)
+    return cached_flux_reference(run_reference, key_parts, use_cache=use_cache)
+
+
+def normalized_run(do_live=False, geo=None, use_cache=True, checkpoint_dir=None, checkpoint_interval=600, step_funcs=(),
+                   **kwargs):
+    ''' Device run normalized by the (cached) reference run. Returns a picklable dict of
+        freqs, R (reflectance) and T (transmittance), so it also works as a ``sweeps.sweep`` factory
+    '''
+    # step_funcs go to both runs, so that a background reporter sees, and can cancel, the reference run too
+    straight_refl_data, straight_tran_flux = reference_run(geo=geo, use_cache=use_cache, step_funcs=step_funcs,
+                                                           **kwargs)
+    sim, refl, tran = do_simrun(base_refl_data=straight_refl_data, do_live=do_live, geo=geo,
+                                checkpoint_dir=checkpoint_dir, checkpoint_interval=checkpoint_interval,
+                                step_funcs=step_funcs, **kwargs)
+    if monitor_mode == 'timeseries':
+        # spectra of the time series are power, and the incident pulse is already subtracted from refl
+        raw = monitor_spectra(refl, tran)
+        return dict(freqs=raw['freqs'], R=raw['refl'] / straight_tran_flux, T=raw['tran'] / straight_tran_flux)
+    spectra = dict(freqs=np.array(mp.get_flux_freqs(refl)),
+                   R=-np.array(mp.get_fluxes(refl)) / straight_tran_flux,
+                   T=np.array(mp.get_fluxes(tran)) / straight_tran_flux)
+    if monitor_mode == 'sparse':
+        spectra = densify(spectra)
+    if isinstance(sim.stop_condition, SpectralConvergence):
+        # scalars, so that sweep results keep the same shape. The full history is in sim.stop_condition
+        spectra.update(converged=sim.stop_condition.converged, stop_time=sim.meep_time())
+    return spectra
+
+
+def background_run(geo=None, name=None, factory=do_simrun, **kwargs):
+    ''' Starts do_simrun (or normalized_run) in its own process and returns a background.BackgroundRun right away.
+        Its ``result()`` is the flux spectra. Keyword arguments go to background.launch and then to the factory.
+        The ETA is to expected_end_time. For normalized_run it covers the device run, not an uncached reference run
+    '''
+    geo = kwargs_to_geo(geo)
+    if 'end_time' not in kwargs:
+        kwargs['end_time'] = expected_end_time(geo, until=kwargs.get('until'))
+    return launch(factory, params=geo, name=name, **kwargs)
+
+
+def point_key(params):
+    # Identifies a sweep point by its full geometry and the fidelity globals, so changing set_sim level reruns it
+    params = dict(params)
+    geo = kwargs_to_geo(params.pop('geo', None), **params)
+    return hash_key(sorted(vars(geo).items()), fcen, df, nfreq, resolution, dpml, monitor_mode)
+
+
+def resumable_sweep(directory, grid, checkpoint_interval=None, **kwargs):
+    ''' A ``sweeps.ResumableSweep`` of ``normalized_run``. Finished points are saved in ``directory`` and skipped on rerun.
+        With checkpoint_interval (in seconds), long points also save their fields that often.
+        Call ``.run(n_workers=...)`` on the result
+    '''
+    if checkpoint_interval is not None:
+        kwargs['checkpoint_interval'] = checkpoint_interval
+    return ResumableSweep(directory, normalized_run, grid, point_key=point_key,
+                          checkpoint_kwarg='checkpoint_dir' if checkpoint_interval is not None else None,
+                          **kwargs)
+
+
+# --- Multi-fidelity resonance search. Replaces editing set_sim1/2/3 and rerunning by hand
+
+# The device searched when no geo is given. It is the same at every level, like set_sim1 left it for set_sim2/3
+search_device = dict(n_periods=10, dw=.3)
+
+# Each level is a resolution plus padding, nothing that changes the device. Level 0 is rough, used for locating resonances
+fidelity_ladder = [
+    dict(resolution=20, buffer=2),
+    dict(resolution=30, buffer=4),
+    dict(resolution=40, buffer=14),
+]
+
+
+@contextmanager
+def fidelity(**settings):
+    # Temporarily sets module globals such as resolution, fcen, df, nfreq
+    module_globals = globals()
+    old_settings = {k: module_globals[k] for k in settings}
+    module_globals.update(settings)
+    try:
+        yield
+    finally:
+        module_globals.update(old_settings)
+
+
+def find_peaks(spectrum, n_peaks=1, min_height=0.1):
+    # Indices of the n_peaks highest local maxima above min_height, in increasing order
+    spectrum = np.asarray(spectrum)
+    interior = (spectrum[1:-1] > spectrum[:-2]) & (spectrum[1:-1] >= spectrum[2:]) & (spectrum[1:-1] > min_height)
+    i_peaks = np.nonzero(interior)[0] + 1
+    i_peaks = i_peaks[np.argsort(spectrum[i_peaks])[::-1]][:n_peaks]
+    return np.sort(i_peaks)
+
+
+def peak_width(freqs, spectrum, i_peak):
+    # Full width at half maximum by linear interpolation. None if a side does not come down to half max
+    spectrum = np.asarray(spectrum)
+    half = spectrum[i_peak] / 2
+    edges = []
+    for step in [-1, 1]:
+        i = i_peak
+        while 0 <= i + step < len(spectrum) and spectrum[i + step] > half:
+            i += step
+        if not 0 <= i + step < len(spectrum):
+            return None
+        f_in, f_out, s_in, s_out = freqs[i], freqs[i + step], spectrum[i], spectrum[i + step]
+        edges.append(f_in + (half - s_in) * (f_out - f_in) / (s_out - s_in))
+    return abs(edges[1] - edges[0])
+
+
+def _level_run(level, geo, kwargs, **settings):
+    level = dict(level)
+    with fidelity(resolution=level.pop('resolution'), **settings):
+        return normalized_run(geo=geo, **dict(kwargs, **level))
+
+
+def resonance_search(geo=None, target='T', n_peaks=1, ladder=None, coarse_nfreq=201, fine_nfreq=101,
+                     window_fwhms=3, min_window=None, min_height=0.1, **kwargs):
+    ''' Finds resonances at low fidelity, then refines each one up the fidelity ladder.
+
+        Level 0 runs the full band (fcen, df) with coarse_nfreq points.
+        At every later level, each peak gets its own run with the source bandwidth and the flux monitors
+        narrowed to a window of +/- window_fwhms linewidths (at least min_window) around the last peak,
+        with fine_nfreq points. Fine grids are only spent where the spectrum has structure.
+        Every level simulates the same device: geo (default: default_geo with search_device) and kwargs.
+        Ladder levels should only change fidelity, such as resolution and buffer.
+
+        Returns a list of dicts, one per peak, with f0, fwhm, Q, the final spectra, and the history of levels
+    '''
+    if ladder is None:
+        ladder = fidelity_ladder
+    if geo is None:
+        geo = kwargs_to_geo(**search_device)
+    if min_window is None:
+        min_window = df / 50
+    t0 = time.time()
+    spectra = _level_run(ladder[0], geo, kwargs, nfreq=coarse_nfreq)
+    freqs = spectra['freqs']
+    peaks = []
+    for i_peak in find_peaks(spectra[target], n_peaks=n_peaks, min_height=min_height):
+        fwhm = peak_width(freqs, spectra[target], i_peak)
+        peaks.append(dict(f0=freqs[i_peak], fwhm=fwhm, spectra=spectra,
+                          history=[dict(level=0, f0=freqs[i_peak], fwhm=fwhm, fcen=fcen, df=df, nfreq=coarse_nfreq)]))
+    print('Level 0: found {} peaks at {}'.format(len(peaks), [round(peak['f0'], 5) for peak in peaks]))
+
+    for i_level, level in enumerate(ladder[1:], start=1):
+        for peak in peaks:
+            half_window = max(window_fwhms * (peak['fwhm'] or 0), min_window / 2)
+            window = dict(fcen=peak['f0'], df=2 * half_window, nfreq=fine_nfreq)
+            spectra = _level_run(level, geo, kwargs, **window)
+            i_peak = int(np.argmax(spectra[target]))
+            fwhm = peak_width(spectra['freqs'], spectra[target], i_peak)
+            peak.update(f0=spectra['freqs'][i_peak], fwhm=fwhm, spectra=spectra)
+            peak['history'].append(dict(level=i_level, f0=peak['f0'], fwhm=fwhm, **window))
+        print('Level {}: peaks at {}'.format(i_level, [round(peak['f0'], 5) for peak in peaks]))
+    for peak in peaks:
+        peak['Q'] = peak['f0'] / peak['fwhm'] if peak['fwhm'] else None
+    print('Resonance search duration = {:.2f} seconds'.format(time.time() - t0))
+    return peaks
@@ -3,7 +3,11 @@
 # From the Meep tutorial: transmission around a 90-degree waveguide bend in 2d.
 from __future__ import division
 
+import sys, os
 import meep as mp
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../jupyter-meep-libs'))
+from caching import cached_flux_reference
+from spectra import SpectralConvergence
 
 resolution = 10 # pixels/um
 
@@ -30,32 +34,42 @@ df = 0.1     # pulse width (in frequency)
 sources = [mp.Source(mp.GaussianSource(fcen,fwidth=df), component=mp.Ez,
                      center=mp.Vector3(-0.5*sx+dpml,wvg_ycen,0),size=mp.Vector3(0,w,0))]
 
-sim = mp.Simulation(cell_size=cell,
-                    boundary_layers=pml_layers,
-                    geometry=geometry,
-                    sources=sources,
-                    resolution=resolution)
-
 nfreq = 100  # number of frequencies at which to compute flux
 # reflected flux
 refl_fr = mp.FluxRegion(center=mp.Vector3(-0.5*sx+dpml+0.5,wvg_ycen,0),size=mp.Vector3(0,2*w,0))
-refl = sim.add_flux(fcen,df,nfreq,refl_fr)
 
 # transmitted flux
 tran_fr = mp.FluxRegion(center=mp.Vector3(0.5*sx-dpml,wvg_ycen,0),size=mp.Vector3(0,2*w,0))
-tran = sim.add_flux(fcen,df,nfreq,tran_fr)
 
-pt = mp.Vector3(0.5*sx-dpml-0.5,wvg_ycen)
+# stop when the flux spectra stop changing, instead of when the field at one point decays.
+# It runs at least as long as light takes to go around the bend at the waveguide index, and at most 5 times that
+stop_on_spectra = True
 
-sim.run(until_after_sources=mp.stop_when_fields_decayed(50,mp.Ez,pt,1e-3))
+def stop_condition(fluxes, pt):
+    if stop_on_spectra:
+        min_time = (sx + sy) * 12 ** 0.5
+        return SpectralConvergence(fluxes, interval=10, tol=1e-3, min_time=min_time, max_time=5 * min_time)
+    return mp.stop_when_fields_decayed(50, mp.Ez, pt, 1e-3)
 
-# for normalization run, save flux fields data for reflection plane
-straight_refl_data = sim.get_flux_data(refl)
+def straight_run():
+    sim = mp.Simulation(cell_size=cell,
+                        boundary_layers=pml_layers,
+                        geometry=geometry,
+                        sources=sources,
+                        resolution=resolution)
+    refl = sim.add_flux(fcen,df,nfreq,refl_fr)
+    tran = sim.add_flux(fcen,df,nfreq,tran_fr)
+
+    pt = mp.Vector3(0.5*sx-dpml-0.5,wvg_ycen)
 
-# save incident power for transmission plane
-straight_tran_flux = mp.get_fluxes(tran)
+    sim.run(until_after_sources=stop_condition([refl, tran], pt))
+    return sim, refl, tran
+
+# for normalization run, save flux fields data for reflection plane
+# and incident power for transmission plane. This is cached on disk, so it only runs once
+reference_key = ('bend-flux', sx, sy, dpml, pad, w, fcen, df, nfreq, resolution, stop_on_spectra)
+straight_refl_data, straight_tran_flux = cached_flux_reference(straight_run, reference_key)
 
-sim.reset_meep()
 
 geometry = [mp.Block(mp.Vector3(sx-pad,w,mp.inf),center=mp.Vector3(-0.5*pad,wvg_ycen),material=mp.Medium(epsilon=12)),
             mp.Block(mp.Vector3(w,sy-pad,mp.inf),center=mp.Vector3(wvg_xcen,0.5*pad),material=mp.Medium(epsilon=12))]
@@ -77,7 +91,7 @@ sim.load_minus_flux_data(refl,straight_refl_data)
 
 pt = mp.Vector3(wvg_xcen,0.5*sy-dpml-0.5)
 
-sim.run(until_after_sources=mp.stop_when_fields_decayed(50, mp.Ez, pt, 1e-3))
+sim.run(until_after_sources=stop_condition([refl, tran], pt))
 
 bend_refl_flux = mp.get_fluxes(refl)
 bend_tran_flux = mp.get_fluxes(tran)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+# Validates the 2D effective index method (2.5D) against one full 3D run of a partially etched MMI 1x2.
+# Both runs see the same phidl device: a wg_deep MMI on a wg_shallow pedestal (conversions.partial_etch_stack).
+# Compares the transmission into each output and the wall time. The 3D run takes a while, run it from a terminal
+import sys, os, time
+import numpy as np
+import meep as mp
+from phidl import Device, geometry as pg
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../jupyter-meep-libs'))
+from conversions import get_layer_mapping, device_to_meep, partial_etch_stack, stack_substrate
+from phidl_examples import lys, mmi1x2
+from partial_wgs import slab_neff, t_si
+
+fcen = 1 / 1.218  # the wavelength slab_neff is solved at
+df = 0.1 * fcen
+nfreq = 21
+dpml = 1.0
+l_access = 4  # access waveguides run through the PML
+pad_y = 1.5
+sz = 2 * (dpml + 0.8)
+
+
+def partial_mmi():
+    D = Device('partial_mmi')
+    mmi = D << mmi1x2()
+    mmi.center = (0, 0)
+    wg_width = 0.35
+    for name, side in [('wg_in_1', 'E'), ('wg_out_1', 'W'), ('wg_out_2', 'W')]:
+        access = D << pg.compass((l_access, wg_width), layer=lys['wg_deep'])
+        access.connect(side, mmi.ports[name])
+        D.add_port(name, midpoint=mmi.ports[name].midpoint, width=wg_width, orientation=mmi.ports[name].orientation)
+    pedestal = D << pg.rectangle((D.xsize + 2, D.ysize + 2 * pad_y + 2), layer=lys['wg_shallow'])
+    pedestal.center = (0, 0)
+    D.flatten()
+    return D
+
+
+def run(three_d, resolution=20):
+    D = partial_mmi()
+    mapping = get_layer_mapping(lys)
+    stack = partial_etch_stack()
+    sx = D.ports['wg_out_1'].x - D.ports['wg_in_1'].x + 2 * (dpml + 1.5)
+    sy = abs(D.ports['wg_out_1'].y - D.ports['wg_out_2'].y) + 2 * (dpml + pad_y)
+    if three_d:
+        _, geometry = device_to_meep(D, mapping, stack=stack)
+        geometry = stack_substrate(t_box=sz) + geometry
+        cell = mp.Vector3(sx, sy, sz)
+        z_port, port_height, parity = t_si / 2, 1.0, mp.NO_PARITY
+    else:
+        _, geometry = device_to_meep(D, mapping, stack=stack, slab_neff=slab_neff)
+        cell = mp.Vector3(sx, sy)
+        z_port, port_height, parity = 0, 0, mp.EVEN_Z
+
+    def port_center(name, outward):
+        # distance from the MMI along the access waveguide
+        port = D.ports[name]
+        return mp.Vector3(port.x + np.sign(port.x) * outward, port.y, z_port)
+
+    port_size = mp.Vector3(0, 1.2, port_height)
+    sources = [mp.EigenModeSource(mp.GaussianSource(fcen, fwidth=df), center=port_center('wg_in_1', 1.0),
+                                  size=port_size, eig_band=1, eig_parity=parity)]
+    sim = mp.Simulation(cell_size=cell,
+                        boundary_layers=[mp.PML(dpml)],
+                        geometry=geometry,
+                        sources=sources,
+                        resolution=resolution)
+    fluxes = {name: sim.add_flux(fcen, df, nfreq, mp.FluxRegion(center=port_center(name, 0.5 if name == 'wg_in_1' else 0.3),
+                                                                size=port_size))
+              for name in ['wg_in_1', 'wg_out_1', 'wg_out_2']}
+    t0 = time.time()
+    sim.run(until_after_sources=mp.stop_when_fields_decayed(50, mp.Ey, port_center('wg_out_1', 0.3), 1e-3))
+    wall_time = time.time() - t0
+    incident = np.array(mp.get_fluxes(fluxes['wg_in_1']))
+    return dict(freqs=np.array(mp.get_flux_freqs(fluxes['wg_in_1'])),
+                T1=np.array(mp.get_fluxes(fluxes['wg_out_1'])) / incident,
+                T2=np.array(mp.get_fluxes(fluxes['wg_out_2'])) / incident,
+                wall_time=wall_time)
+
+
+def compare(resolution=20):
+    eim = run(False, resolution)
+    full = run(True, resolution)
+    iCenter = nfreq // 2
+    print('{:>6} {:>10} {:>10} {:>12}'.format('', 'T1(fcen)', 'T2(fcen)', 'wall time'))
+    for label, res in [('2.5D', eim), ('3D', full)]:
+        print('{:>6} {:>10.3f} {:>10.3f} {:>10.1f} s'.format(label, res['T1'][iCenter], res['T2'][iCenter], res['wall_time']))
+    T_err = max(np.max(np.abs(eim[name] - full[name])) for name in ['T1', 'T2'])
+    print('Max transmission error over the band: {:.3f}. Speedup: {:.0f}x'.format(T_err, full['wall_time'] / eim['wall_time']))
+    return eim, full
+
+
+if __name__ == '__main__':
+    compare()
@@ -1,6 +1,9 @@
+import sys, os
 import meep as mp
 from meep import mpb
 import numpy as np
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../jupyter-meep-libs'))
+from caching import DiskCache, hash_key
 Si = mp.Medium(index=3.45)
 ColdSi = mp.Medium(index=3.49)
 SiO2 = mp.Medium(index=1.45)
@@ -81,3 +84,139 @@ def get_ks(xs=None, freq=1/1.218, num_bands=1):
                        kmag_guess, kmag_min, kmag_max,)
                        # mpb.output_poynting_x)#, mpb.display_group_velocities)
     return k_calc
+
+
+# --- Batched, warm-started effective index tables
+
+neff_cache = DiskCache('neff', max_bytes=50e6)
+
+
+def _neighbor_k(idx, k_grid):
+    # An already solved neighbor of grid index idx, preferring the last axis, or None
+    for axis in reversed(range(len(idx))):
+        if idx[axis] > 0:
+            neighbor = list(idx)
+            neighbor[axis] -= 1
+            k_prev = k_grid[tuple(neighbor)][0]
+            if np.isfinite(k_prev):
+                return k_prev
+    return None
+
+
+def _multilinear(axes, data, point):
+    # Interpolates data (shape of axes, plus trailing dims) at point, a list of coordinates. Clamps at the edges
+    weights = [(slice(None), 1.)]
+    for axis_vals, coord in zip(axes, point):
+        if len(axis_vals) == 1:
+            weights = [(sl + (0,) if isinstance(sl, tuple) else (0,), w) for sl, w in weights]
+            continue
+        i = int(np.clip(np.searchsorted(axis_vals, coord) - 1, 0, len(axis_vals) - 2))
+        t = float(np.clip((coord - axis_vals[i]) / (axis_vals[i + 1] - axis_vals[i]), 0, 1))
+        new_weights = []
+        for sl, w in weights:
+            sl = sl if isinstance(sl, tuple) else ()
+            new_weights.extend([(sl + (i,), w * (1 - t)), (sl + (i + 1,), w * t)])
+        weights = new_weights
+    return sum(w * data[sl] for sl, w in weights)
+
+
+class NeffTable(object):
+    ''' Effective and group index over a grid of get_xs parameters, interpolated multilinearly.
+        Query with the same keywords the table was built on, such as ``table.neff(wg_width=.42)``
+    '''
+    def __init__(self, names, axes, freq, k, ng):
+        self.names = names
+        self.axes = axes
+        self.freq = freq
+        self.k = k
+        self.ng_grid = ng
+
+    def _point(self, point):
+        missing = set(self.names) - set(point.keys())
+        if missing:
+            raise KeyError('Table needs values for {}'.format(sorted(missing)))
+        return [point[name] for name in self.names]
+
+    def neff(self, band=1, **point):
+        return _multilinear(self.axes, self.k, self._point(point))[band - 1] / self.freq
+
+    def ng(self, band=1, **point):
+        return _multilinear(self.axes, self.ng_grid, self._point(point))[band - 1]
+
+
+def neff_table(freq=1/1.218, num_bands=1, bracket=0.1, use_cache=True, **axes):
+    ''' Solves find_k over a grid of get_xs parameters, for example
+        ``neff_table(wg_width=np.linspace(.3, .6, 7), encapsulation=[.05, .1])``
+
+        One ModeSolver is reused. Each point is seeded from an already solved neighbor, with the kmag bracket
+        narrowed to +/- bracket (relative) around it. The result is cached on disk, so repeating it is instant.
+        Returns a NeffTable
+    '''
+    names = sorted(axes.keys())
+    axis_vals = [np.sort(np.atleast_1d(np.asarray(axes[name], dtype=float))) for name in names]
+    materials = [mat.epsilon_diag.x for mat in (Si, ColdSi, SiO2, Cladding)]
+    key = hash_key('neff_table-v1', freq, num_bands, bracket, resolution, names, [vals.tolist() for vals in axis_vals],
+                   sc_y, sc_z, t_si, t_ped, w_ped, t_box, t_top, materials)
+    arrays = neff_cache.get(key) if use_cache else None
+    if arrays is None:
+        shape = tuple(len(vals) for vals in axis_vals)
+        k_grid = np.full(shape + (num_bands,), np.nan)
+        ng_grid = np.full(shape + (num_bands,), np.nan)
+        ms = get_ms(get_xs(), num_bands=num_bands)
+        kdir = mp.Vector3(1)
+        for idx in np.ndindex(*shape):
+            point = {name: vals[i] for name, vals, i in zip(names, axis_vals, idx)}
+            ms.geometry = get_xs(**point)
+            group_velocities = dict()
+            def capture_vg(ms, band):
+                group_velocities[band] = ms.compute_one_group_velocity_component(kdir, band)
+            wide = (freq*3.45, freq*0.1, freq*4.0)
+            k_seed = _neighbor_k(idx, k_grid)
+            if k_seed is None or num_bands > 1:
+                attempts = [wide] if k_seed is None else [(k_seed, ) + wide[1:]]
+            else:
+                attempts = [(k_seed, k_seed * (1 - bracket), k_seed * (1 + bracket)), wide]
+            for iAttempt, (kmag_guess, kmag_min, kmag_max) in enumerate(attempts):
+                try:
+                    k_calc = ms.find_k(mp.ODD_Y, freq, 1, num_bands, kdir, 1e-6,
+                                       kmag_guess, kmag_min, kmag_max, capture_vg)
+                    break
+                except Exception:
+                    if iAttempt == len(attempts) - 1:
+                        raise
+            k_grid[idx] = k_calc[:num_bands]
+            ng_grid[idx] = [1 / group_velocities.get(band, np.nan) for band in range(1, num_bands + 1)]
+        arrays = dict(k=k_grid, ng=ng_grid)
+        if use_cache:
+            neff_cache.put(key, arrays)
+    return NeffTable(names, axis_vals, freq, arrays['k'], arrays['ng'])
+
+
+# --- Vertical slab effective indices, for 2D effective-index (2.5D) FDTD
+
+def get_slab(thickness):
+    # Vertical cross section of a uniform silicon slab of this thickness on the BOX, in a 1D lattice along z
+    return [mp.Block(size=mp.Vector3(mp.inf, mp.inf, t_top), center=mp.Vector3(z=t_top/2), material=Cladding),
+            mp.Block(size=mp.Vector3(mp.inf, mp.inf, t_box), center=mp.Vector3(z=-t_box/2), material=SiO2),
+            mp.Block(size=mp.Vector3(mp.inf, mp.inf, thickness), center=mp.Vector3(z=thickness/2), material=ColdSi)]
+
+
+def slab_neff(thickness, freq=1/1.218, use_cache=True):
+    ''' Effective index of the fundamental TE slab mode of silicon this thick. Cached on disk.
+        This is the vertical problem of the effective index method: give it to
+        ``conversions.device_to_meep(..., stack=partial_etch_stack(), slab_neff=slab_neff)``
+    '''
+    materials = [mat.epsilon_diag.x for mat in (ColdSi, SiO2, Cladding)]
+    key = hash_key('slab_neff-v1', thickness, freq, resolution, t_box, t_top, materials)
+    arrays = neff_cache.get(key) if use_cache else None
+    if arrays is None:
+        ms = mpb.ModeSolver(geometry_lattice=mp.Lattice(size=mp.Vector3(0, 0, sc_z)),
+                            geometry=get_slab(thickness),
+                            resolution=resolution,
+                            num_bands=1)
+        k_calc = ms.find_k(mp.ODD_Y, freq, 1, 1, mp.Vector3(1), 1e-6,
+                           freq*3.45, cutoff_k(freq), freq*4.0)
+        arrays = dict(k=np.array(k_calc[:1]))
+        if use_cache:
+            neff_cache.put(key, arrays)
+    return float(arrays['k'][0]) / freq
@@ -1,5 +1,8 @@
+import sys, os
 import meep as mp
 from meep import mpb
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../jupyter-meep-libs'))
+from bands import parallel_bands
 
 resolution = 64  # pixels/um
 
@@ -26,23 +29,29 @@ k_min = 0.1
 k_max = 2.0
 k_points = mp.interpolate(num_k, [mp.Vector3(k_min), mp.Vector3(k_max)])
 
-ms = mpb.ModeSolver(
+solver_kwargs = dict(
     geometry_lattice=geometry_lattice,
     geometry=geometry,
-    k_points=k_points,
     resolution=resolution,
     num_bands=num_bands)
 
-ms.run(mpb.display_yparities)
-
-f_mode = 1/1.55  # frequency corresponding to 1.55 um
-band_min = 1
-band_max = 1
-kdir = mp.Vector3(1)
-tol = 1e-6
-kmag_guess = f_mode*3.45
-kmag_min = f_mode*0.1
-kmag_max = f_mode*4.0
-
-ms.find_k(mp.ODD_Y, f_mode, band_min, band_max, kdir, tol, kmag_guess,
-          kmag_min, kmag_max, mpb.output_poynting_x, mpb.display_group_velocities)
\ No newline at end of file
+# guarded, because with spawn every worker imports this script again
+if __name__ == '__main__':
+    # k-points are split across processes
+    all_freqs, yparities = parallel_bands(solver_kwargs, k_points, parity='y')
+    for k, freqs, parities in zip(k_points, all_freqs, yparities):
+        print('k = {:.3f}: freqs {}, y-parities {}'.format(k.x, freqs, parities))
+
+    ms = mpb.ModeSolver(k_points=k_points, **solver_kwargs)
+
+    f_mode = 1/1.55  # frequency corresponding to 1.55 um
+    band_min = 1
+    band_max = 1
+    kdir = mp.Vector3(1)
+    tol = 1e-6
+    kmag_guess = f_mode*3.45
+    kmag_min = f_mode*0.1
+    kmag_max = f_mode*4.0
+
+    ms.find_k(mp.ODD_Y, f_mode, band_min, band_max, kdir, tol, kmag_guess,
+              kmag_min, kmag_max, mpb.output_poynting_x, mpb.display_group_velocities)